@@ -69,3 +69,13 @@ class DailySurveyQuestions(Enum):
         ],
         "is_custom_option_allowed": True,  # Можно указать свой вариант ответа
     }
+
+
+# Тексты вопросов ежедневного опроса, которые задаются без обращения
+# к GPT (см. services/survey_engine.py). Ответы ассистента для этого не
+# используются: в них часто пересказываются ответы конкретного пользователя
+DAILY_SURVEY_QUESTION_TEXTS = {
+    "QUESTION_3": "Где именно болит голова?",
+    "QUESTION_4": "С какой стороны болит голова?",
+    "QUESTION_5": "Какой характер боли?",
+}
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import json
 import logging
@@ -5,19 +6,38 @@ from datetime import datetime
 from dateutil import parser
 from supabase import create_client, Client
 from handlers.meta import validate_json_format
-from services.audio_text_processor import process_audio_and_text
-from services.extract_marker_and_options import extract_marker_and_options
-from services.openai_service import get_new_thread_id, send_to_gpt
-from services.yandex_service import (
-    synthesize_speech,
-    translate_text,
+from services.audio_text_processor import RecognitionResult, ingest_message
+from services.extract_marker_and_options import get_question_options
+from services import greeting_cache, survey_engine
+from services.openai_service import (
+    AssistantReply,
+    send_to_gpt,
 )
+from services.thread_pool import acquire_thread_id
+from services.transcoder import is_adts
+from services.tts_cache import (
+    remember_question_text,
+    synthesize_speech_cached,
+    split_into_sentences,
+    start_segment_synthesis,
+)
+from services.yandex_service import is_translation_error, translate_text
 from utils import redis_client
 from utils.config import SUPABASE_URL, SUPABASE_KEY
 from models import User, Message, Survey
 from crud import Postgres
 from utils.config import ASSISTANT2_ID, ASSISTANT_ID
-from utils.redis_client import clear_user_state
+from utils.config import (
+    PROGRESSIVE_AUDIO_DELIVERY,
+    AUDIO_DELIVERY_TIMEOUT,
+    TTS_SENTENCE_STREAMING,
+    OPENAI_STREAMING,
+    TURN_DEADLINE,
+    TRANSLATION_MIN_BUDGET,
+)
+from utils import metrics
+from utils.deadline import Deadline
+from utils.redis_client import finish_session
 
 
 # Инициализация логирования
@@ -29,28 +49,33 @@ logger = logging.getLogger(__name__)
 # Инициализация Supabase
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+# Ответы, аудио для которых еще синтезируется: message_id -> asyncio.Event,
+# который выставляется после отправки клиенту текстового сообщения
+audio_delivery_gates = {}
+
 
-async def process_message(record, user_language, db: Postgres):
+async def process_message(
+    record,
+    user_language,
+    db: Postgres,
+    recognition=None,
+    send_event=None,
+    deadline=None,
+    on_commit=None,
+):
+    """
+    on_commit вызывается, как только ответ на сообщение получен (GPT,
+    кеш приветствия или локальный шаг опроса): после этого ход нельзя
+    отменять, иначе сообщение будет отправлено в тред повторно.
+    """
+    if deadline is None:
+        deadline = Deadline(TURN_DEADLINE)
+    if on_commit is None:
+        on_commit = lambda: None
     try:
         user_id = record["user_id"]
         content = record["content"]
         content_dict = json.loads(content)
-        message_id = record.get(
-            "message_id"
-        )  # Предполагаем, что message_id доступен в записи
-
-        # Проверяем, было ли сообщение уже обработано
-        is_processed = await redis_client.is_message_processed(
-            user_id, message_id
-        )
-        if is_processed:
-            logger.info(
-                f"Message {message_id} already processed for user {user_id}. Skipping."
-            )
-            return {
-                "status": "success",
-                "message": "Message already processed.",
-            }
 
         gpt_response_json_new = None
         created_at_str = None
@@ -65,20 +90,39 @@ async def process_message(record, user_language, db: Postgres):
 
         message_data = content_dict
 
-        text = await process_audio_and_text(message_data, user_language)
+        # Распознавание выполняется один раз: если результат уже получен
+        # на этапе приема сообщения, повторно аудио не обрабатывается
+        if recognition is None:
+            recognition = await deadline.run(
+                ingest_message(message_data, user_language),
+                "stt",
+                default=RecognitionResult(text=None, is_audio=True),
+            )
+        text = recognition.text
 
-        if user_language == "kk":
+        if user_language == "kk" and text:
+            # Если перевод не успел или не удался, GPT получает текст
+            # без перевода
             try:
-                text = translate_text(text, source_lang="kk", target_lang="ru")
+                translated = await deadline.run(
+                    translate_text(text, source_lang="kk", target_lang="ru"),
+                    "translation",
+                    default=text,
+                )
+                if is_translation_error(translated):
+                    logger.error(f"Translation failed: {translated}")
+                else:
+                    text = translated
                 logger.info(f"Translation result: {text}")
             except Exception as e:
                 logger.error(f"Translation failed: {e}")
-                text = None
 
         if text is None:
             response_text = "К сожалению, я не смог распознать ваш голос. Пожалуйста, повторите свой запрос."
             message_id, gpt_response_json, created_at_str = (
-                await save_response_to_db(user_id, response_text, db)
+                await save_response_to_db(
+                    user_id, response_text, db, send_event, deadline
+                )
             )
             logger.info("Text is None, saved response to DB and returning.")
             return {
@@ -86,9 +130,14 @@ async def process_message(record, user_language, db: Postgres):
                 "message_id": message_id,
                 "gpt_response_json": gpt_response_json,
                 "created_at_str": created_at_str,
+                "completed": True,
             }
 
-        user_state = await redis_client.get_user_state(str(user_id))
+        on_delta = build_delta_forwarder(record, user_language, send_event)
+
+        # Состояние, тред и ассистент читаются из Redis одним запросом
+        session = await redis_client.get_session(str(user_id))
+        user_state = session.get("state")
         logger.info(f"Retrieved state {user_state} for user_id {user_id}")
 
         if user_state is None:
@@ -106,22 +155,52 @@ async def process_message(record, user_language, db: Postgres):
 
             assistant_id = ASSISTANT2_ID if not user else ASSISTANT_ID
 
-            new_thread_id = await get_new_thread_id()
-            await redis_client.save_thread_id(str(user_id), new_thread_id)
-            await redis_client.save_assistant_id(str(user_id), assistant_id)
+            new_thread_id = await acquire_thread_id(assistant_id)
+            await redis_client.start_session(
+                str(user_id),
+                thread_id=new_thread_id,
+                assistant_id=assistant_id,
+            )
             logger.info(
                 f"Generated and saved new thread_id {new_thread_id} for user {user_id}"
             )
 
-            logger.info(f"Sending initial message to GPT for user {user_id}")
-            response_text, new_thread_id, full_response = await send_to_gpt(
-                "Здравствуйте", new_thread_id, assistant_id
+            greeting = await greeting_cache.get_cached_greeting(
+                assistant_id, user_language
             )
+            if greeting is not None and new_thread_id:
+                logger.info(f"Using cached greeting for user {user_id}")
+                response_text = greeting["text"]
+                full_response = greeting_cache.seed_thread_with_greeting(
+                    new_thread_id, greeting
+                )
+                on_commit()
+            else:
+                logger.info(
+                    f"Sending initial message to GPT for user {user_id}"
+                )
+                response_text, new_thread_id, full_response = (
+                    await send_to_gpt(
+                        greeting_cache.GREETING_PROMPT,
+                        new_thread_id,
+                        assistant_id,
+                        on_delta=on_delta,
+                        deadline=deadline,
+                    )
+                )
+                on_commit()
 
-            if user_language == "kk":
-                response_text = translate_text(
-                    response_text, source_lang="ru", target_lang="kk"
+                response_text, is_translated = await translate_reply(
+                    response_text, user_language, deadline
                 )
+                # Приветствие без перевода в кеш не попадает
+                if is_translated:
+                    await greeting_cache.store_greeting(
+                        assistant_id,
+                        user_language,
+                        response_text,
+                        full_response,
+                    )
 
             if not response_text:
                 logger.error("Initial response text is empty.")
@@ -131,12 +210,20 @@ async def process_message(record, user_language, db: Postgres):
                     "error_message": "Initial response text is empty.",
                 }
 
-            response_text, options_data = extract_marker_and_options(
-                response_text, assistant_id
+            question_marker = full_response.marker if full_response else None
+            options_data = get_question_options(question_marker, assistant_id)
+            await survey_engine.record_question(
+                user_id, assistant_id, question_marker
             )
+            if options_data:
+                await remember_question_text(
+                    assistant_id, question_marker, user_language, response_text
+                )
 
             message_id, gpt_response_json, created_at_str = (
-                await save_response_to_db(user_id, response_text, db)
+                await save_response_to_db(
+                    user_id, response_text, db, send_event, deadline
+                )
             )
 
             gpt_response_dict = json.loads(gpt_response_json)
@@ -159,21 +246,39 @@ async def process_message(record, user_language, db: Postgres):
             logger.info(
                 f"User {user_id} sent a message, forwarding content to GPT."
             )
-            thread_id = await redis_client.get_thread_id(user_id)
-            assistant_id = await redis_client.get_assistant_id(user_id)
-            await redis_client.save_assistant_id(str(user_id), assistant_id)
-
-            if isinstance(assistant_id, bytes):
-                assistant_id = assistant_id.decode("utf-8")
-            response_text, new_thread_id, full_response = await send_to_gpt(
-                text, thread_id, assistant_id
+            thread_id = session.get("thread_id")
+            assistant_id = session.get("assistant_id")
+            # Ответ-вариант на шаг опроса обрабатывается без запуска GPT
+            local_turn = await survey_engine.try_answer_locally(
+                user_id, text, session, user_language
             )
-            await redis_client.save_thread_id(str(user_id), new_thread_id)
-
-            if user_language == "kk":
-                response_text = translate_text(
-                    response_text, source_lang="ru", target_lang="kk"
+            if local_turn is not None:
+                on_commit()
+                response_text = local_turn.text
+                full_response = AssistantReply(
+                    text=local_turn.text,
+                    marker=local_turn.marker,
+                    completed=True,
                 )
+            else:
+                response_text, new_thread_id, full_response = (
+                    await send_to_gpt(
+                        text,
+                        thread_id,
+                        assistant_id,
+                        on_delta=on_delta,
+                        deadline=deadline,
+                    )
+                )
+                on_commit()
+                if new_thread_id and new_thread_id != thread_id:
+                    await redis_client.advance_session(
+                        str(user_id), thread_id=new_thread_id
+                    )
+
+            response_text, _ = await translate_reply(
+                response_text, user_language, deadline
+            )
 
             if not response_text:
                 logger.error("Response text is empty.")
@@ -183,14 +288,22 @@ async def process_message(record, user_language, db: Postgres):
                     "error_message": "Response text is empty.",
                 }
 
-            response_text, options_data = extract_marker_and_options(
-                response_text, assistant_id
+            question_marker = full_response.marker if full_response else None
+            options_data = get_question_options(question_marker, assistant_id)
+            await survey_engine.record_question(
+                user_id, assistant_id, question_marker
             )
+            if options_data:
+                await remember_question_text(
+                    assistant_id, question_marker, user_language, response_text
+                )
             logger.info(f"options_data: {options_data}")
             logger.info(f"assistant_id: {assistant_id}")
 
             message_id, gpt_response_json, created_at_str = (
-                await save_response_to_db(user_id, response_text, db)
+                await save_response_to_db(
+                    user_id, response_text, db, send_event, deadline
+                )
             )
 
             gpt_response_dict = json.loads(gpt_response_json)
@@ -217,15 +330,16 @@ async def process_message(record, user_language, db: Postgres):
                 f"response_text in process message: {response_text[:200]}"
             )
 
-        await redis_client.mark_message_as_processed(user_id, message_id)
         if await final_response_reached(full_response):
-            await clear_user_state(user_id, [message_id])
+            await finish_session(user_id)
 
+        # completed: ответ получен, а не заменен сообщением об ошибке GPT
         return {
             "status": "success",
             "message_id": message_id,
             "gpt_response_json": gpt_response_json_new,
             "created_at_str": created_at_str,
+            "completed": full_response is not None and full_response.completed,
         }
 
     except Exception as e:
@@ -237,32 +351,56 @@ async def process_message(record, user_language, db: Postgres):
         }
 
 
-async def final_response_reached(full_response):
+def build_delta_forwarder(record, user_language, send_event):
     """
-    Определяет, является ли текущий ответ финальным, основываясь на содержании полного ответа от GPT.
+    Возвращает функцию, пересылающую клиенту фрагменты ответа GPT
+    сообщениями message_delta, или None, если потоковый режим недоступен.
+    Для казахского языка ответ переводится целиком, поэтому фрагменты
+    на русском не отправляются.
     """
-    try:
-        # Проход по всем сообщениям в полном ответе
-        for msg in full_response.data:
-            for content in msg.content:
-                text = content.text.value if hasattr(content, "text") else ""
-
-                # Проверка на наличие JSON с маркером окончания
-                if "json" in text:
-                    return True
-        return False
-    except Exception as e:
-        logger.error(f"Error determining final response: {e}")
-        return False
+    if send_event is None or not OPENAI_STREAMING or user_language == "kk":
+        return None
+
+    front_id = record.get("front_id")
+
+    async def on_delta(delta):
+        await send_event(
+            {
+                "type": "message_delta",
+                "data": {"delta": delta, "front_id": front_id},
+            }
+        )
+
+    return on_delta
 
 
-async def save_response_to_db(user_id, response_text, db):
+async def final_response_reached(reply):
+    """
+    Определяет, является ли текущий ответ финальным: финальный ответ
+    ассистента содержит блок JSON с итогами анкеты.
+    """
+    return reply is not None and reply.is_final
+
+
+async def save_response_to_db(
+    user_id, response_text, db, send_event=None, deadline=None
+):
+    if send_event is not None and PROGRESSIVE_AUDIO_DELIVERY:
+        return await save_text_response_to_db(
+            user_id, response_text, db, send_event
+        )
+
     try:
         if response_text:
             logger.info(
                 f"Response text before synthesis: {response_text[:100]}"
             )
-            audio_response = synthesize_speech(response_text, "ru")
+            synthesis = synthesize_speech_cached(response_text, "ru")
+            if deadline is None:
+                audio_response = await synthesis
+            else:
+                audio_response = await deadline.run(synthesis, "tts")
+
             if audio_response:
                 audio_response_encoded = base64.b64encode(
                     audio_response
@@ -271,159 +409,404 @@ async def save_response_to_db(user_id, response_text, db):
                     {"text": response_text, "audio": audio_response_encoded},
                     ensure_ascii=False,
                 )
-
-                logger.info(
-                    f"Saving GPT response to the database for user {user_id}"
-                )
-                saved_message = await db.add_entity(
-                    {
-                        "user_id": str(user_id),
-                        "content": gpt_response_json,
-                        "is_created_by_user": False,
-                    },
-                    Message,
+            elif deadline is not None and deadline.expired():
+                # Синтез не уложился в бюджет хода: ответ без аудио
+                gpt_response_json = json.dumps(
+                    {"text": response_text}, ensure_ascii=False
                 )
-                logger.info(f"Response saved to database: for user {user_id}")
-
-                message_id = saved_message.id
-                created_at = saved_message.created_at
-                created_at_str = created_at.strftime("%Y-%m-%dT%H:%M:%SZ")
-                logger.info(f"Message ID retrieved: {message_id}")
-
-                return str(message_id), gpt_response_json, created_at_str
             else:
                 logger.error(
                     f"Audio response is None for text: {response_text[:100]}"
                 )
+                return
+
+            logger.info(
+                f"Saving GPT response to the database for user {user_id}"
+            )
+            saved_message = await db.add_entity(
+                {
+                    "user_id": str(user_id),
+                    "content": gpt_response_json,
+                    "is_created_by_user": False,
+                },
+                Message,
+            )
+            logger.info(f"Response saved to database: for user {user_id}")
+
+            message_id = saved_message.id
+            created_at = saved_message.created_at
+            created_at_str = created_at.strftime("%Y-%m-%dT%H:%M:%SZ")
+            logger.info(f"Message ID retrieved: {message_id}")
+
+            return str(message_id), gpt_response_json, created_at_str
         else:
             logger.error("Response text is empty, cannot save to database.")
     except Exception as e:
         logger.error(f"Error in save_response_to_db: {e}")
 
 
-async def parse_and_save_json_response(
-    user_id, full_response, db, assistant_id
+async def translate_reply(response_text, user_language, deadline):
+    """
+    Переводит ответ GPT на казахский. Если на перевод не осталось
+    времени, ответ отправляется на русском. Возвращает текст и признак
+    того, что он на языке пользователя.
+    """
+    if user_language != "kk":
+        return response_text, True
+    if not deadline.allows(TRANSLATION_MIN_BUDGET):
+        deadline.degrade("translation")
+        return response_text, False
+
+    translated = await deadline.run(
+        translate_text(response_text, source_lang="ru", target_lang="kk"),
+        "translation",
+    )
+    if not translated or is_translation_error(translated):
+        return response_text, False
+    return translated, True
+
+
+async def save_text_response_to_db(user_id, response_text, db, send_event):
+    """
+    Сохраняет текст ответа сразу, без ожидания синтеза речи.
+    Аудио синтезируется в фоне и отправляется клиенту сообщением
+    audio_ready (или по предложениям сообщениями audio_chunk),
+    после чего запись в базе дополняется аудио.
+    """
+    audio_tasks = []
+    try:
+        if not response_text:
+            logger.error("Response text is empty, cannot save to database.")
+            return
+
+        gpt_response_json = json.dumps(
+            {"text": response_text, "audio_pending": True},
+            ensure_ascii=False,
+        )
+        # Синтез стартует параллельно с записью в базу
+        if TTS_SENTENCE_STREAMING:
+            audio_tasks = start_segment_synthesis(
+                split_into_sentences(response_text), "ru"
+            )
+        else:
+            audio_tasks = [
+                asyncio.ensure_future(
+                    synthesize_speech_cached(response_text, "ru")
+                )
+            ]
+
+        saved_message = await db.add_entity(
+            {
+                "user_id": str(user_id),
+                "content": gpt_response_json,
+                "is_created_by_user": False,
+            },
+            Message,
+        )
+        if saved_message is None:
+            for audio_task in audio_tasks:
+                audio_task.cancel()
+            logger.error(f"Failed to save text response for user {user_id}")
+            return
+
+        message_id = str(saved_message.id)
+        created_at_str = saved_message.created_at.strftime(
+            "%Y-%m-%dT%H:%M:%SZ"
+        )
+        gate = asyncio.Event()
+        audio_delivery_gates[message_id] = gate
+        deliver = (
+            deliver_audio_chunks if len(audio_tasks) > 1 else deliver_audio
+        )
+        asyncio.create_task(
+            deliver(
+                saved_message.id,
+                response_text,
+                audio_tasks,
+                db,
+                send_event,
+                gate,
+            )
+        )
+        logger.info(f"Text response {message_id} saved, audio pending")
+        return message_id, gpt_response_json, created_at_str
+    except asyncio.CancelledError:
+        # Ход отменен до сохранения ответа: синтез больше не нужен
+        for audio_task in audio_tasks:
+            audio_task.cancel()
+        raise
+    except Exception as e:
+        logger.error(f"Error in save_text_response_to_db: {e}")
+
+
+def release_audio_delivery(message_id):
+    """
+    Разрешает отправку audio_ready: вызывается после того, как клиент
+    получил текстовое сообщение с этим message_id.
+    """
+    gate = audio_delivery_gates.get(message_id)
+    if gate is not None:
+        gate.set()
+
+
+async def deliver_audio(
+    message_uuid, response_text, audio_tasks, db, send_event, gate
 ):
+    message_id = str(message_uuid)
+    started_at = asyncio.get_running_loop().time()
     try:
-        final_response_json = None
-        for msg in full_response.data:
-            for content in msg.content:
-                text = content.text.value if hasattr(content, "text") else ""
-                if "json" in text:
-                    final_response_json = text
-                    break
-            if final_response_json:
-                break
-
-        if final_response_json:
-            logger.info(
-                f"Extracting JSON from response: {final_response_json}"
+        audio_response = await audio_tasks[0]
+        if not audio_response:
+            logger.error(f"Audio response is None for message {message_id}")
+            metrics.increment("audio_delivery", status="synthesis_failed")
+            return
+
+        audio_response_encoded = base64.b64encode(audio_response).decode(
+            "utf-8"
+        )
+        try:
+            await asyncio.wait_for(gate.wait(), timeout=AUDIO_DELIVERY_TIMEOUT)
+            await send_event(
+                {
+                    "type": "audio_ready",
+                    "data": {
+                        "id": message_id,
+                        "audio": audio_response_encoded,
+                    },
+                }
             )
-            json_start = final_response_json.find("```json")
-            json_end = final_response_json.rfind("```")
-            if json_start != -1 and json_end != -1:
-                response_data_str = final_response_json[
-                    json_start + len("```json") : json_end
-                ].strip()
-                response_data = json.loads(response_data_str)
-                response_data["userid"] = str(user_id)
-                logger.info(f"userid: {response_data['userid']}")
-                logger.info(f"response_data: {response_data}")
-
-                if isinstance(assistant_id, bytes):
-                    assistant_id = assistant_id.decode("utf-8")
-
-                if (
-                    "birthdate" in response_data
-                    and response_data["birthdate"] is not None
-                ):
-                    try:
-                        birthdate_str = response_data["birthdate"].strip()
-                        try:
-                            birthdate = datetime.strptime(
-                                birthdate_str, "%d.%m.%Y"
-                            ).date()
-                        except ValueError:
-                            birthdate = parser.parse(birthdate_str).date()
-                        response_data["birthdate"] = birthdate
-                    except ValueError as e:
-                        logger.error(f"Error parsing birthdate: {e}")
-
-                if (
-                    "reminder_time" in response_data
-                    and response_data["reminder_time"]
-                ):
-                    try:
-                        reminder_time_str = response_data["reminder_time"]
-                        reminder_time = datetime.strptime(
-                            reminder_time_str, "%H:%M"
-                        ).time()
-                        response_data["reminder_time"] = reminder_time
-                        logger.info(
-                            f"Converted reminder_time: {reminder_time}"
-                        )
-                    except ValueError as e:
-                        logger.error(f"Error parsing reminder_time: {e}")
+            metrics.increment("audio_delivery", status="sent")
+            metrics.observe(
+                "audio_delivery_seconds",
+                asyncio.get_running_loop().time() - started_at,
+            )
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Text message {message_id} was not delivered in time"
+            )
+            metrics.increment("audio_delivery", status="timeout")
+        except Exception as e:
+            logger.error(f"Failed to send audio for message {message_id}: {e}")
+            metrics.increment("audio_delivery", status="send_failed")
+
+        # Аудио сохраняется в историю, даже если клиент уже отключился
+        await db.update_entity_parameter(
+            message_uuid,
+            "content",
+            json.dumps(
+                {"text": response_text, "audio": audio_response_encoded},
+                ensure_ascii=False,
+            ),
+            Message,
+        )
+    except Exception as e:
+        logger.error(f"Error delivering audio for message {message_id}: {e}")
+        metrics.increment("audio_delivery", status="error")
+    finally:
+        audio_delivery_gates.pop(message_id, None)
 
-                # Updating user data in the database
-                if assistant_id == ASSISTANT2_ID:
-                    user_exists = await db.get_entity_parameter(
-                        User, {"userid": response_data["userid"]}, None
+
+async def deliver_audio_chunks(
+    message_uuid, response_text, audio_tasks, db, send_event, gate
+):
+    """
+    Отправляет аудио по предложениям (audio_chunk) строго по порядку,
+    по мере готовности фрагментов: воспроизведение первого предложения
+    начинается, пока остальные еще синтезируются.
+    """
+    message_id = str(message_uuid)
+    started_at = asyncio.get_running_loop().time()
+    chunks = []
+    try:
+        try:
+            await asyncio.wait_for(gate.wait(), timeout=AUDIO_DELIVERY_TIMEOUT)
+            is_client_waiting = True
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Text message {message_id} was not delivered in time"
+            )
+            metrics.increment("audio_delivery", status="timeout")
+            is_client_waiting = False
+
+        for index, audio_task in enumerate(audio_tasks):
+            audio_chunk = await audio_task
+            if not audio_chunk:
+                logger.error(
+                    f"Audio chunk {index} is None for message {message_id}"
+                )
+                metrics.increment("audio_delivery", status="synthesis_failed")
+                return
+            chunks.append(audio_chunk)
+
+            if not is_client_waiting:
+                continue
+            try:
+                await send_event(
+                    {
+                        "type": "audio_chunk",
+                        "data": {
+                            "id": message_id,
+                            "index": index,
+                            "total": len(audio_tasks),
+                            "is_last": index == len(audio_tasks) - 1,
+                            "audio": base64.b64encode(audio_chunk).decode(
+                                "utf-8"
+                            ),
+                        },
+                    }
+                )
+                if index == 0:
+                    metrics.observe(
+                        "audio_first_chunk_seconds",
+                        asyncio.get_running_loop().time() - started_at,
                     )
-                    if user_exists:
-                        for parameter, value in response_data.items():
-                            if parameter != "userid" and value:
-                                try:
-                                    logger.info(
-                                        f"Updating {parameter} with value {value} for user {response_data['userid']}"
-                                    )
-                                    await db.update_entity_parameter(
-                                        entity_id=response_data["userid"],
-                                        parameter=parameter,
-                                        value=value,
-                                        model_class=User,
-                                    )
-                                    logger.info(
-                                        f"Updated {parameter} successfully"
-                                    )
-                                except Exception as e:
-                                    logger.error(
-                                        f"Error updating {parameter}: {e}"
-                                    )
-                    else:
-                        try:
-                            await db.add_entity(response_data, User)
-                            logger.info(
-                                f"New user {response_data['userid']} added to the database"
-                            )
-                        except Exception as e:
-                            logger.error(
-                                f"Error adding new user to database: {e}"
-                            )
-                else:
-                    try:
-                        # Проверка наличия ключа 'pain_intensity' в словаре response_data
-                        if "pain_intensity" in response_data and response_data[
-                            "pain_intensity"
-                        ] not in [None, ""]:
-                            response_data["pain_intensity"] = int(
-                                response_data["pain_intensity"]
-                            )
-                        else:
-                            response_data["pain_intensity"] = 0
+            except Exception as e:
+                logger.error(
+                    f"Failed to send audio chunk for message {message_id}: {e}"
+                )
+                metrics.increment("audio_delivery", status="send_failed")
+                is_client_waiting = False
+
+        if is_client_waiting:
+            metrics.increment("audio_delivery", status="sent")
+            metrics.observe(
+                "audio_delivery_seconds",
+                asyncio.get_running_loop().time() - started_at,
+            )
 
-                        logger.info(
-                            f"pain_intensity: {response_data['pain_intensity']}"
-                        )
+        # Фрагменты ADTS склеиваются в одно аудио для истории,
+        # иначе ответ синтезируется целиком
+        if all(is_adts(chunk) for chunk in chunks):
+            audio_response = b"".join(chunks)
+        else:
+            audio_response = await synthesize_speech_cached(
+                response_text, "ru"
+            )
+        if audio_response:
+            await db.update_entity_parameter(
+                message_uuid,
+                "content",
+                json.dumps(
+                    {
+                        "text": response_text,
+                        "audio": base64.b64encode(audio_response).decode(
+                            "utf-8"
+                        ),
+                    },
+                    ensure_ascii=False,
+                ),
+                Message,
+            )
+    except Exception as e:
+        logger.error(f"Error delivering audio for message {message_id}: {e}")
+        metrics.increment("audio_delivery", status="error")
+    finally:
+        for audio_task in audio_tasks:
+            audio_task.cancel()
+        audio_delivery_gates.pop(message_id, None)
+
+
+async def parse_and_save_json_response(user_id, reply, db, assistant_id):
+    try:
+        if reply is not None and reply.final_json is not None:
+            response_data = dict(reply.final_json)
+            logger.info(f"Final JSON from response: {response_data}")
+            response_data["userid"] = str(user_id)
+            logger.info(f"userid: {response_data['userid']}")
+            logger.info(f"response_data: {response_data}")
+
+            if isinstance(assistant_id, bytes):
+                assistant_id = assistant_id.decode("utf-8")
 
-                        await db.add_entity(response_data, Survey)
+            if (
+                "birthdate" in response_data
+                and response_data["birthdate"] is not None
+            ):
+                try:
+                    birthdate_str = response_data["birthdate"].strip()
+                    try:
+                        birthdate = datetime.strptime(
+                            birthdate_str, "%d.%m.%Y"
+                        ).date()
+                    except ValueError:
+                        birthdate = parser.parse(birthdate_str).date()
+                    response_data["birthdate"] = birthdate
+                except ValueError as e:
+                    logger.error(f"Error parsing birthdate: {e}")
+
+            if (
+                "reminder_time" in response_data
+                and response_data["reminder_time"]
+            ):
+                try:
+                    reminder_time_str = response_data["reminder_time"]
+                    reminder_time = datetime.strptime(
+                        reminder_time_str, "%H:%M"
+                    ).time()
+                    response_data["reminder_time"] = reminder_time
+                    logger.info(f"Converted reminder_time: {reminder_time}")
+                except ValueError as e:
+                    logger.error(f"Error parsing reminder_time: {e}")
+
+            # Updating user data in the database
+            if assistant_id == ASSISTANT2_ID:
+                user_exists = await db.get_entity_parameter(
+                    User, {"userid": response_data["userid"]}, None
+                )
+                if user_exists:
+                    for parameter, value in response_data.items():
+                        if parameter != "userid" and value:
+                            try:
+                                logger.info(
+                                    f"Updating {parameter} with value {value} for user {response_data['userid']}"
+                                )
+                                await db.update_entity_parameter(
+                                    entity_id=response_data["userid"],
+                                    parameter=parameter,
+                                    value=value,
+                                    model_class=User,
+                                )
+                                logger.info(
+                                    f"Updated {parameter} successfully"
+                                )
+                            except Exception as e:
+                                logger.error(
+                                    f"Error updating {parameter}: {e}"
+                                )
+                else:
+                    try:
+                        await db.add_entity(response_data, User)
                         logger.info(
-                            f"Survey response saved for user {user_id}"
+                            f"New user {response_data['userid']} added to the database"
                         )
                     except Exception as e:
-                        logger.error(
-                            f"Error adding or updating response to database: {e}"
+                        logger.error(f"Error adding new user to database: {e}")
+            else:
+                try:
+                    response_data = await survey_engine.merge_local_answers(
+                        user_id, response_data
+                    )
+
+                    # Проверка наличия ключа 'pain_intensity' в словаре response_data
+                    if "pain_intensity" in response_data and response_data[
+                        "pain_intensity"
+                    ] not in [None, ""]:
+                        response_data["pain_intensity"] = int(
+                            response_data["pain_intensity"]
                         )
+                    else:
+                        response_data["pain_intensity"] = 0
+
+                    logger.info(
+                        f"pain_intensity: {response_data['pain_intensity']}"
+                    )
+
+                    await db.add_entity(response_data, Survey)
+                    logger.info(f"Survey response saved for user {user_id}")
+                except Exception as e:
+                    logger.error(
+                        f"Error adding or updating response to database: {e}"
+                    )
 
     except Exception as e:
         logger.error(f"Error saving response to database: {e}")
@@ -6,8 +6,19 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from handlers.process_message import process_message
 from crud import Postgres
 from services.database import async_session
+from services.thread_pool import maintain_thread_pool
+from services.tts_cache import prewarm_tts_cache
 from services.yandex_service import get_iam_token, refresh_iam_token
 from server import main as websocket_server
+from utils import metrics
+from utils.config import REDIS_NEAR_CACHE
+from utils.redis_client import (
+    local_cache_stats,
+    near_cache_stats,
+    redis,
+    session_near_cache,
+)
+from utils.http_client import close_http_client
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -40,14 +51,38 @@ class Message(BaseModel):
 async def startup_event():
     try:
         logger.info("Supabase startup_event.")
-        get_iam_token()
+        await get_iam_token()
         task = asyncio.create_task(refresh_iam_token())
         _ = task
+        asyncio.create_task(prewarm_tts_cache())
+        asyncio.create_task(maintain_thread_pool())
+        if REDIS_NEAR_CACHE:
+            asyncio.create_task(session_near_cache.run(redis))
         asyncio.ensure_future(websocket_server())
     except Exception as e:
         logger.error(f"Error during startup event: {e}")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_http_client()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
+
+@app.get("/metrics/local-cache")
+async def get_local_cache_stats():
+    return local_cache_stats()
+
+
+@app.get("/metrics/near-cache")
+async def get_near_cache_stats():
+    return near_cache_stats()
+
+
 if __name__ == "__main__":
     import uvicorn
 
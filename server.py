@@ -1,40 +1,30 @@
 import asyncio
-import httpx
+import functools
 import websockets
 import json
 from crud import Postgres
 from handlers.meta import get_user_language
 from models import Message, User
-from services.audio_text_processor import process_audio_and_text
+from services.audio_text_processor import RecognitionResult, ingest_message
+from services.auth_service import AuthSession, get_connection_token
 from services.database import async_session
-from handlers.process_message import process_message
+from services.conversation_actor import ConversationActorRegistry
+from services import idempotency
+from handlers.process_message import process_message, release_audio_delivery
 import logging
 import ftfy
 from services.history_service import generate_chat_history
 from services.language_service import change_language
 from services.reminder_service import change_reminder_time
 from services.statistics_service import generate_statistics_file
-from utils.redis_client import clear_user_state
+from utils.config import CANCEL_TURNS_ON_DISCONNECT, TURN_DEADLINE
+from utils.deadline import Deadline
+from utils.redis_client import finish_session
 
 db = Postgres(async_session)
 logger = logging.getLogger(__name__)
 
 
-async def verify_token_with_auth_server(token):
-    try:
-        url = "https://backoffice.daribar.com/api/v1/users"
-        headers = {"Authorization": f"Bearer {token}"}
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers)
-            if response.status_code == 200:
-                return response.json()
-            else:
-                return None
-    except Exception as e:
-        logger.error(f"Error verifying token: {e}")
-        return None
-
-
 async def handle_command(action, user_id, database: Postgres, data=None):
 
     if action == "fetch_history":
@@ -150,7 +140,7 @@ async def handle_command(action, user_id, database: Postgres, data=None):
     elif action == "initial_chat":
         try:
             # Очищаем стейт для пользователя перед началом нового чата
-            await clear_user_state(user_id, [])
+            await finish_session(user_id)
 
             user_language = await database.get_entity_parameter(
                 User, {"userid": user_id}, "language"
@@ -206,14 +196,417 @@ async def handle_command(action, user_id, database: Postgres, data=None):
     }
 
 
+async def send_server_error(websocket, e):
+    try:
+        await websocket.send(
+            json.dumps(
+                {
+                    "type": "response",
+                    "status": "error",
+                    "error": "server_error",
+                    "message": f"Error processing message: {str(e)}",
+                },
+                ensure_ascii=False,
+            )
+        )
+    except Exception as send_error:
+        logger.error(
+            f"Failed to send error message over WebSocket: {send_error}"
+        )
+
+
+async def send_message_confirmation(websocket, saved_message):
+    response_from_bot_user = {
+        "type": "response",
+        "status": "success",
+        "action": "message",
+        "data": {
+            "id": str(saved_message.id),
+            "created_at": saved_message.created_at.strftime(
+                "%Y-%m-%dT%H:%M:%SZ"
+            ),
+            "content": saved_message.content,
+            "is_created_by_user": True,
+            "front_id": saved_message.front_id,
+        },
+    }
+
+    try:
+        log_message = json.dumps(response_from_bot_user, ensure_ascii=False)
+        shortened_log_message = f"{log_message[:300]}...{log_message[-200:]}"
+        logger.info(
+            f"Sending response to user (success confirmation): {shortened_log_message}"
+        )
+        await websocket.send(
+            json.dumps(response_from_bot_user, ensure_ascii=False)
+        )
+    except Exception as e:
+        logger.error(f"Failed to send JSON response (user confirmation): {e}")
+        response_error = {
+            "type": "response",
+            "status": "error",
+            "error": "json_serialization_error",
+            "message": f"Error serializing response to JSON: {str(e)}",
+        }
+        # Сообщение уже сохранено: закрытое соединение не должно
+        # превращать прием в ошибку
+        try:
+            await websocket.send(
+                json.dumps(response_error, ensure_ascii=False)
+            )
+        except Exception as send_error:
+            logger.error(
+                f"Failed to send error message over WebSocket: {send_error}"
+            )
+
+
+async def accept_user_message(websocket, data, content, user_id, send_event):
+    """
+    Прием сообщения пользователя: распознавание, запись в базу и
+    подтверждение клиенту. Ответ GPT формируется отдельно, возможно сразу
+    на несколько сообщений (см. ConversationActor).
+    """
+    # Бюджет распознавания отсчитывается с начала приема, а не с
+    # получения кадра: ожидание в очереди актора в него не входит
+    deadline = Deadline(TURN_DEADLINE)
+    front_id = data.get("data").get("front_id")
+    accepted = False
+    try:
+        is_created_by_user = data.get("data").get("is_created_by_user")
+
+        user_language = await get_user_language(
+            user_id, content.get("language"), db
+        )
+        recognition = await deadline.run(
+            ingest_message(content, user_language),
+            "stt",
+            default=RecognitionResult(text=None, is_audio=True),
+        )
+        if recognition.text:
+            content["text"] = recognition.text
+        else:
+            content["text"] = "аудио не распознано"
+
+        message_data = {
+            "user_id": user_id,
+            "content": json.dumps(content, ensure_ascii=False),
+            "is_created_by_user": is_created_by_user,
+            "front_id": front_id,
+        }
+        saved_message = await db.add_entity(message_data, Message)
+
+        if saved_message:
+            logger.info(f"saved_messaage: {saved_message}")
+            await idempotency.mark_accepted(
+                user_id, front_id, saved_message.id
+            )
+            accepted = True
+            await send_message_confirmation(websocket, saved_message)
+        else:
+            await idempotency.release_message(user_id, front_id)
+
+        return {
+            "websocket": websocket,
+            "send_event": send_event,
+            "message_id": saved_message.id if saved_message else None,
+            "message_data": message_data,
+            "recognition": recognition,
+            "user_language": user_language,
+        }
+    except Exception as e:
+        logger.error(f"Error accepting user message: {e}")
+        # Сохраненное сообщение не освобождается, иначе повтор запишет
+        # его в базу второй раз
+        if not accepted:
+            await idempotency.release_message(user_id, front_id)
+        await send_server_error(websocket, e)
+        return None
+
+
+async def accept_stored_user_message(
+    websocket, user_id, front_id, state, send_event
+):
+    """
+    Повтор сообщения, которое уже записано в базу, но ответа на которое
+    нет (например, ход был отменен при разрыве соединения): распознавание
+    и запись не повторяются, ход выполняется по сохраненному тексту.
+    """
+    try:
+        # Пока повтор ждал в очереди, на оригинал мог прийти ответ
+        current = await idempotency.get_state(user_id, front_id)
+        if current is not None:
+            state = current
+        if state["status"] == idempotency.ANSWERED:
+            await replay_answered_message(websocket, state)
+            return None
+
+        saved_message = await db.get_entity_parameter(
+            Message, {"id": state["message_id"]}, None
+        )
+        if not saved_message:
+            logger.error(f"Stored message {state['message_id']} not found")
+            return None
+        await send_message_confirmation(websocket, saved_message)
+
+        content = json.loads(saved_message.content)
+        user_language = await get_user_language(
+            user_id, content.get("language"), db
+        )
+        text = content.get("text")
+        recognition = RecognitionResult(
+            text=None if text == "аудио не распознано" else text,
+            is_audio=bool(content.get("audio")),
+        )
+        return {
+            "websocket": websocket,
+            "send_event": send_event,
+            "message_id": saved_message.id,
+            "message_data": {
+                "user_id": user_id,
+                "content": saved_message.content,
+                "is_created_by_user": saved_message.is_created_by_user,
+                "front_id": saved_message.front_id,
+            },
+            "recognition": recognition,
+            "user_language": user_language,
+        }
+    except Exception as e:
+        logger.error(f"Error accepting stored user message: {e}")
+        await send_server_error(websocket, e)
+        return None
+
+
+async def accept_retried_user_message(
+    websocket, data, content, user_id, send_event
+):
+    """
+    Повтор сообщения, оригинал которого еще принимается: ждем, пока он
+    будет записан или отвечен, и обрабатываем повтор по результату.
+    """
+    front_id = data.get("data").get("front_id")
+    state = await idempotency.wait_until_resolved(
+        user_id, front_id, TURN_DEADLINE
+    )
+    if state is None:
+        # Оригинал не удалось принять, повтор обрабатывается как новый
+        return await accept_user_message(
+            websocket, data, content, user_id, send_event
+        )
+    if state["status"] == idempotency.ACCEPTED:
+        return await accept_stored_user_message(
+            websocket, user_id, front_id, state, send_event
+        )
+    if state["status"] == idempotency.ANSWERED:
+        await replay_answered_message(websocket, state)
+        return None
+
+    response = {
+        "type": "response",
+        "status": "error",
+        "action": "message",
+        "error": "message_in_progress",
+        "message": "The message is still being processed. Please retry.",
+        "data": {"front_id": front_id},
+    }
+    await websocket.send(json.dumps(response, ensure_ascii=False))
+    return None
+
+
+async def replay_answered_message(websocket, state):
+    """
+    Повтор сообщения, на которое уже есть ответ: клиенту заново
+    отправляются подтверждение и сохраненный ответ, GPT не вызывается.
+    """
+    saved_message = await db.get_entity_parameter(
+        Message, {"id": state["message_id"]}, None
+    )
+    if saved_message:
+        await send_message_confirmation(websocket, saved_message)
+
+    reply = state["reply"]
+    reply_message = await db.get_entity_parameter(
+        Message, {"id": reply["id"]}, None
+    )
+    if not reply_message:
+        logger.error(f"Stored reply {reply['id']} not found")
+        return
+
+    content = json.loads(reply_message.content)
+    content.update(reply["extra"])
+    # Повтору audio_ready не отправляется: в ответе есть только то аудио,
+    # которое уже записано в базу
+    content.pop("audio_pending", None)
+    response = {
+        "type": "message",
+        "data": {
+            "id": reply["id"],
+            "created_at": reply["created_at"],
+            "content": json.dumps(content, ensure_ascii=False),
+            "is_created_by_user": False,
+        },
+    }
+    await websocket.send(json.dumps(response, ensure_ascii=False))
+
+
+async def mark_messages_answered(messages, result):
+    # В базе хранятся только текст и аудио ответа, остальные поля
+    # (варианты ответа) сохраняются вместе с состоянием сообщения.
+    # audio_pending относится только к первой отправке ответа
+    extra = {
+        key: value
+        for key, value in json.loads(result["gpt_response_json"]).items()
+        if key not in ("text", "audio", "audio_pending")
+    }
+    reply = {
+        "id": str(result["message_id"]),
+        "created_at": result["created_at_str"],
+        "extra": extra,
+    }
+    for message in messages:
+        if message["message_id"] is None:
+            continue
+        message_data = message["message_data"]
+        await idempotency.mark_answered(
+            message_data["user_id"],
+            message_data["front_id"],
+            message["message_id"],
+            reply,
+        )
+
+
+def merge_user_messages(messages):
+    """
+    Объединяет несколько сообщений, пришедших подряд, в один запрос к GPT.
+    """
+    last = messages[-1]
+    if len(messages) == 1:
+        return last["message_data"], last["recognition"]
+
+    texts = [m["recognition"].text for m in messages if m["recognition"].text]
+    merged_text = "\n".join(texts) if texts else None
+    content = json.loads(last["message_data"]["content"])
+    content["text"] = merged_text or "аудио не распознано"
+    record = dict(
+        last["message_data"], content=json.dumps(content, ensure_ascii=False)
+    )
+    recognition = RecognitionResult(
+        text=merged_text,
+        is_audio=any(m["recognition"].is_audio for m in messages),
+    )
+    return record, recognition
+
+
+async def respond_to_user_messages(messages, on_commit=None):
+    """
+    Один ход пользователя: ответ GPT, синтез речи и запись в базу на одно
+    или несколько принятых сообщений. Ход может быть отменен, если клиент
+    отключился или прислал новое сообщение.
+    """
+    # Повтор сообщения, пришедший по новому соединению, заменяет оригинал
+    messages = list(
+        {
+            message["message_id"] or id(message): message
+            for message in messages
+        }.values()
+    )
+    last = messages[-1]
+    websocket = last["websocket"]
+    # Бюджет хода отсчитывается с его начала: ожидание в очереди и прием
+    # сообщений в него не входят
+    deadline = Deadline(TURN_DEADLINE)
+    try:
+        record, recognition = merge_user_messages(messages)
+        result = await process_message(
+            record,
+            last["user_language"],
+            db,
+            recognition,
+            last["send_event"],
+            deadline,
+            on_commit,
+        )
+
+        if result["status"] == "error":
+            error_response = {
+                "type": "response",
+                "status": "error",
+                "error": result["error_type"],
+                "message": result["error_message"],
+            }
+            await websocket.send(
+                json.dumps(error_response, ensure_ascii=False)
+            )
+        else:
+            # Ответ отмечается до отправки: повтор, пришедший во время
+            # отправки, получит сохраненный ответ, а не новый ход.
+            # Сообщения без полученного ответа остаются принятыми, и
+            # повтор клиента выполнит ход заново
+            if result["completed"]:
+                await mark_messages_answered(messages, result)
+            success_response = {
+                "type": "message",
+                "data": {
+                    "id": result["message_id"],
+                    "created_at": result["created_at_str"],
+                    "content": result["gpt_response_json"],
+                    "is_created_by_user": False,
+                },
+            }
+            await websocket.send(
+                json.dumps(success_response, ensure_ascii=False)
+            )
+            # Аудио ответа (если оно еще синтезируется) уходит
+            # только после текстового сообщения
+            release_audio_delivery(result["message_id"])
+
+    except Exception as e:
+        logger.error(f"Error processing message: {e}")
+        response = {
+            "type": "response",
+            "status": "error",
+            "error": "server_error",
+            "message": str(e),
+        }
+        try:
+            await websocket.send(json.dumps(response, ensure_ascii=False))
+        except Exception as send_error:
+            logger.error(
+                f"Failed to send error message over WebSocket: {send_error}"
+            )
+
+
+# Акторы пользователей: сообщения одного пользователя обрабатываются
+# по порядку, а пришедшие подряд объединяются в один запрос к GPT
+conversation_actors = ConversationActorRegistry(respond_to_user_messages)
+
+
 async def handle_connection(websocket, path):
+    # Токен проверяется один раз на соединение, далее user_id берется из сессии
+    auth_session = AuthSession()
+    connection_token = get_connection_token(websocket, path)
+    if connection_token:
+        await auth_session.authenticate(connection_token)
+
+    async def send_event(payload):
+        await websocket.send(json.dumps(payload, ensure_ascii=False))
+
+    # Пользователь, от имени которого соединение отправляло сообщения
+    connection_user_id = None
+
+    async def cancel_turn_on_close():
+        await websocket.wait_closed()
+        if CANCEL_TURNS_ON_DISCONNECT and connection_user_id:
+            await conversation_actors.disconnect(connection_user_id, websocket)
+
+    asyncio.create_task(cancel_turn_on_close())
+
     async for message in websocket:
         try:
             data = json.loads(message)
             logger.info(f"data: {data}")
             token = data.get("token")
-            user_data = await verify_token_with_auth_server(token)
-            if not user_data:
+            user_id = await auth_session.authenticate(token)
+            if not user_id:
                 response = {
                     "type": "response",
                     "status": "error",
@@ -223,8 +616,16 @@ async def handle_connection(websocket, path):
                 await websocket.send(json.dumps(response, ensure_ascii=False))
                 continue
 
-            user_id = user_data["result"]["phone"]
             message_type = data.get("type")
+            if message_type == "auth":
+                response = {
+                    "type": "response",
+                    "status": "success",
+                    "action": "auth",
+                }
+                await websocket.send(json.dumps(response, ensure_ascii=False))
+                continue
+
             action = data.get("action")
 
             try:
@@ -273,113 +674,38 @@ async def handle_connection(websocket, path):
                 await websocket.send(json.dumps(response, ensure_ascii=False))
             elif message_type == "message":
 
-                is_created_by_user = data.get("data").get("is_created_by_user")
-                front_id = data.get("data").get("front_id")
-
-                user_language = await get_user_language(
-                    user_id, content.get("language"), db
-                )
-                text = await process_audio_and_text(content, user_language)
-                if text:
-                    content["text"] = text
+                connection_user_id = user_id
+                # Повтор клиента определяется до распознавания и GPT
+                front_id = data.get("data", {}).get("front_id")
+                state = await idempotency.claim_message(user_id, front_id)
+                message_args = (websocket, data, content, user_id, send_event)
+                release = None
+                if state is None:
+                    accept = functools.partial(
+                        accept_user_message, *message_args
+                    )
+                    # Сообщение, отброшенное до приема, можно повторить
+                    release = functools.partial(
+                        idempotency.release_message, user_id, front_id
+                    )
+                elif state["status"] == idempotency.ACCEPTED:
+                    accept = functools.partial(
+                        accept_stored_user_message,
+                        websocket,
+                        user_id,
+                        front_id,
+                        state,
+                        send_event,
+                    )
+                elif state["status"] == idempotency.ANSWERED:
+                    await replay_answered_message(websocket, state)
+                    continue
                 else:
-                    content["text"] = "аудио не распознано"
-
-                message_data = {
-                    "user_id": user_id,
-                    "content": json.dumps(content, ensure_ascii=False),
-                    "is_created_by_user": is_created_by_user,
-                    "front_id": front_id,
-                }
-                try:
-                    saved_message = await db.add_entity(message_data, Message)
-
-                    if saved_message:
-                        logger.info(f"saved_messaage: {saved_message}")
-
-                        response_from_bot_user = {
-                            "type": "response",
-                            "status": "success",
-                            "action": "message",
-                            "data": {
-                                "id": str(saved_message.id),
-                                "created_at": saved_message.created_at.strftime(
-                                    "%Y-%m-%dT%H:%M:%SZ"
-                                ),
-                                "content": saved_message.content,
-                                "is_created_by_user": True,
-                                "front_id": saved_message.front_id,
-                            },
-                        }
-
-                        try:
-                            log_message = json.dumps(
-                                response_from_bot_user, ensure_ascii=False
-                            )
-                            shortened_log_message = (
-                                f"{log_message[:300]}...{log_message[-200:]}"
-                            )
-                            logger.info(
-                                f"Sending response to user (success confirmation): {shortened_log_message}"
-                            )
-                            await websocket.send(
-                                json.dumps(
-                                    response_from_bot_user, ensure_ascii=False
-                                )
-                            )
-                        except Exception as e:
-                            logger.error(
-                                f"Failed to send JSON response (user confirmation): {e}"
-                            )
-                            response_error = {
-                                "type": "response",
-                                "status": "error",
-                                "error": "json_serialization_error",
-                                "message": f"Error serializing response to JSON: {str(e)}",
-                            }
-                            await websocket.send(
-                                json.dumps(response_error, ensure_ascii=False)
-                            )
-
-                    result = await process_message(
-                        message_data, user_language, db
+                    accept = functools.partial(
+                        accept_retried_user_message, *message_args
                     )
 
-                    if result["status"] == "error":
-                        error_response = {
-                            "type": "response",
-                            "status": "error",
-                            "error": result["error_type"],
-                            "message": result["error_message"],
-                        }
-                        await websocket.send(
-                            json.dumps(error_response, ensure_ascii=False)
-                        )
-                    else:
-                        success_response = {
-                            "type": "message",
-                            "data": {
-                                "id": result["message_id"],
-                                "created_at": result["created_at_str"],
-                                "content": result["gpt_response_json"],
-                                "is_created_by_user": False,
-                            },
-                        }
-                        await websocket.send(
-                            json.dumps(success_response, ensure_ascii=False)
-                        )
-
-                except Exception as e:
-                    logger.error(f"Error processing message: {e}")
-                    response = {
-                        "type": "response",
-                        "status": "error",
-                        "error": "server_error",
-                        "message": str(e),
-                    }
-                    await websocket.send(
-                        json.dumps(response, ensure_ascii=False)
-                    )
+                conversation_actors.post(user_id, websocket, accept, release)
 
         except websockets.exceptions.ConnectionClosedError as e:
             logger.error(f"Connection closed unexpectedly: {e}")
@@ -0,0 +1,205 @@
+import json
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+from constants.assistants_answers_var import (
+    RegistrationQuestions,
+    DailySurveyQuestions,
+)
+from services.extract_marker_and_options import extract_question_marker
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class AssistantReply:
+    """
+    Parsed result of one assistant run.
+
+    text is the user-visible reply without the question marker and the
+    ```json block, marker is the [QUESTION_n] marker (without brackets)
+    and final_json is the decoded final survey/registration payload.
+    completed is set for replies parsed from a finished run and for
+    replies built without a run (cached greeting, local survey step), not
+    for the fallback replies built when a run fails or times out.
+    """
+
+    text: str
+    marker: Optional[str] = None
+    final_json: Optional[dict] = None
+    is_final: bool = False
+    run_id: Optional[str] = None
+    completed: bool = False
+
+
+def parse_assistant_reply(raw_text, run_id=None):
+    """
+    Разбирает текст ответа ассистента один раз: отделяет маркер вопроса
+    и блок ```json с итоговыми данными анкеты.
+    """
+    json_start = raw_text.find("```json")
+    visible_text = raw_text if json_start == -1 else raw_text[:json_start]
+    text, marker = extract_question_marker(visible_text.strip())
+
+    final_json = None
+    if json_start != -1:
+        json_end = raw_text.rfind("```")
+        if json_end > json_start:
+            try:
+                final_json = json.loads(
+                    raw_text[json_start + len("```json") : json_end].strip()
+                )
+            except ValueError as e:
+                logger.error(f"Failed to decode final JSON from reply: {e}")
+
+    return AssistantReply(
+        text=text,
+        marker=marker,
+        final_json=final_json,
+        is_final=json_start != -1,
+        run_id=run_id,
+        completed=True,
+    )
+
+
+QUESTION_MARKERS = sorted(
+    set(RegistrationQuestions.__members__)
+    | set(DailySurveyQuestions.__members__)
+)
+
+# Функции, через которые ассистент передает маркер вопроса и итоговые
+# данные анкеты вместо [QUESTION_n] и блока ```json в тексте
+STRUCTURED_OUTPUT_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "present_question",
+            "description": (
+                "Сообщить маркер вопроса анкеты, который задан "
+                "пользователю в этом ответе."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "marker": {"type": "string", "enum": QUESTION_MARKERS}
+                },
+                "required": ["marker"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "submit_result",
+            "description": (
+                "Передать итоговые данные анкеты после ответа на последний "
+                "вопрос."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "data": {
+                        "type": "object",
+                        "description": (
+                            "Итоговые данные анкеты с теми же полями, что "
+                            "и в JSON-блоке из инструкций."
+                        ),
+                    }
+                },
+                "required": ["data"],
+            },
+        },
+    },
+]
+
+STRUCTURED_OUTPUT_INSTRUCTIONS = (
+    "Не пиши маркер [QUESTION_n] и блок ```json в тексте ответа. "
+    "Задав вопрос анкеты, вызови функцию present_question с его маркером. "
+    "Итоговые данные анкеты передай функцией submit_result. "
+    "После вызова функции ничего не добавляй к ответу."
+)
+
+
+def apply_tool_calls(reply, tool_calls):
+    """
+    Дополняет ответ данными из вызовов present_question и submit_result.
+    tool_calls - пары (имя функции, аргументы в JSON).
+    """
+    for name, arguments in tool_calls:
+        try:
+            arguments = json.loads(arguments or "{}")
+        except ValueError as e:
+            logger.error(f"Failed to decode arguments of {name}: {e}")
+            continue
+
+        if name == "present_question":
+            reply.marker = arguments.get("marker")
+        elif name == "submit_result":
+            reply.final_json = arguments.get("data") or {}
+            reply.is_final = True
+        else:
+            logger.error(f"Unexpected tool call from assistant: {name}")
+    return reply
+
+
+# Начало служебной части ответа, которую клиент не должен видеть
+STREAM_STOP_SEQUENCES = ("[QUESTION_", "```")
+
+
+class ReplyDeltaFilter:
+    """
+    Filters streamed text deltas down to the user-visible part of a reply.
+
+    Everything starting at a [QUESTION_n] marker or a ```json block is
+    withheld, and a tail that may be the beginning of such a sequence is
+    buffered until the next delta disambiguates it.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.emitted = 0
+        self.stopped = False
+
+    def feed(self, delta):
+        self.text += delta
+        if self.stopped:
+            return ""
+
+        visible_end = len(self.text)
+        for sequence in STREAM_STOP_SEQUENCES:
+            index = self.text.find(sequence)
+            if index != -1:
+                visible_end = min(visible_end, index)
+                self.stopped = True
+
+        if not self.stopped:
+            for sequence in STREAM_STOP_SEQUENCES:
+                for length in range(len(sequence) - 1, 0, -1):
+                    if self.text.endswith(sequence[:length]):
+                        visible_end = min(visible_end, len(self.text) - length)
+                        break
+
+        return self.emit(visible_end)
+
+    def flush(self):
+        if self.stopped:
+            return ""
+        return self.emit(len(self.text))
+
+    def emit(self, visible_end):
+        if visible_end <= self.emitted:
+            return ""
+        chunk = self.text[self.emitted : visible_end]
+        self.emitted = visible_end
+        return chunk
+
+
+async def forward_delta(on_delta, chunk):
+    if not chunk:
+        return
+    try:
+        await on_delta(chunk)
+    except Exception as e:
+        # Ошибка отправки клиенту не должна прерывать генерацию ответа
+        logger.error(f"Failed to forward message delta: {e}")
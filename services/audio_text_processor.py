@@ -1,87 +1,143 @@
 import base64
-import io
-import subprocess
-import tempfile
-from pydub import AudioSegment
+import hashlib
+import json
 import logging
-from pydub.exceptions import CouldntDecodeError
+from dataclasses import dataclass
+from typing import Optional
+
+from aioredis.exceptions import RedisError
+
+from utils.config import STT_CACHE_TTL, STT_CACHE_MAX_SIZE
+from utils.redis_client import redis
+from utils.single_flight import SingleFlight
+from utils.ttl_cache import TTLCache
+from .transcoder import convert_to_ogg, TranscodingError
 from .yandex_service import recognize_speech
 
 logger = logging.getLogger(__name__)
 
+# Результаты распознавания по хешу аудио и языку
+stt_cache = TTLCache("stt_results", STT_CACHE_MAX_SIZE, STT_CACHE_TTL)
 
-async def process_audio_and_text(message_data, user_language):
-    text = None
+# Распознавания, которые выполняются прямо сейчас
+pending_recognitions = SingleFlight()
+
+
+@dataclass
+class RecognitionResult:
+    """
+    Result of the ingestion stage: the text of the message, either as sent
+    by the user or recognized from the attached audio.
+    """
+
+    text: Optional[str]
+    is_audio: bool
+    audio_hash: Optional[str] = None
+    from_cache: bool = False
 
-    is_audio = "audio" in message_data and message_data["audio"]
-    if is_audio:
-        try:
-            audio_content_encoded = message_data["audio"]
-            audio_content = base64.b64decode(audio_content_encoded)
-            logger.info("Successfully decoded base64 audio content.")
-
-            # Сохранение аудиоданных в временный файл
-            temp_input = tempfile.NamedTemporaryFile(
-                delete=False, suffix=".aac"
-            )
-            with open(temp_input.name, "wb") as f:
-                f.write(audio_content)
-            logger.info(f"Saved AAC data to temporary file: {temp_input.name}")
-
-            # Попытка конвертировать с помощью ffmpeg в формат WAV
-            try:
-                temp_output = tempfile.NamedTemporaryFile(
-                    delete=False, suffix=".wav"
-                )
-                ffmpeg_command = [
-                    "ffmpeg",
-                    "-y",
-                    "-i",
-                    temp_input.name,
-                    temp_output.name,
-                ]
-                subprocess.run(ffmpeg_command, check=True)
-                logger.info(f"Successfully converted AAC to WAV using ffmpeg.")
-
-                # Загрузка результата и обработка с помощью AudioSegment
-                with open(temp_output.name, "rb") as f:
-                    wav_data = f.read()
-                audio = AudioSegment.from_file(
-                    io.BytesIO(wav_data), format="wav"
-                )
-                logger.info("Successfully created AudioSegment from WAV data.")
-            except subprocess.CalledProcessError as e:
-                logger.error(f"ffmpeg failed to convert AAC to WAV: {e}")
-                raise CouldntDecodeError(
-                    "Failed to decode AAC file using ffmpeg"
-                )
-
-            # Конвертируем в OGG
-            try:
-                ogg_io = io.BytesIO()
-                audio.export(ogg_io, format="ogg")
-                ogg_io.seek(0)
-                audio_content = ogg_io.read()
-                logger.info("Successfully converted audio to OGG format.")
-            except Exception as e:
-                logger.error(f"Failed to convert audio to OGG format: {e}")
-                raise
-
-            # Получаем данные для транскрибации
-            try:
-                text = recognize_speech(
-                    audio_content,
-                    lang="kk-KK" if user_language == "kk" else "ru-RU",
-                )
-                logger.info(f"Speech recognition result: {text}")
-            except Exception as e:
-                logger.error(f"Speech recognition failed: {e}")
-                text = None
-
-        except Exception as e:
-            logger.error(f"Error processing audio message: {e}")
-            text = None
-    else:
-        text = message_data["text"]
 
+async def transcribe_audio(audio_content, user_language):
+    # Конвертируем AAC в OGG в памяти, без временных файлов
+    try:
+        audio_content = await convert_to_ogg(audio_content)
+        logger.info("Successfully converted audio to OGG format.")
+    except TranscodingError as e:
+        logger.error(f"ffmpeg failed to convert audio to OGG: {e}")
+        raise
+
+    # Получаем данные для транскрибации
+    try:
+        text = await recognize_speech(
+            audio_content,
+            lang="kk-KK" if user_language == "kk" else "ru-RU",
+        )
+        logger.info(f"Speech recognition result: {text}")
+    except Exception as e:
+        logger.error(f"Speech recognition failed: {e}")
+        text = None
     return text
+
+
+async def get_cached_recognition(cache_key):
+    cached = stt_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    try:
+        cached = await redis.get(f"stt:{cache_key}")
+        if cached:
+            cached = json.loads(cached)
+            stt_cache.set(cache_key, cached)
+            return cached
+    except (RedisError, ValueError) as e:
+        logger.error(f"Failed to read STT result from Redis: {e}")
+    return None
+
+
+async def store_recognition(cache_key, text):
+    cached = {"text": text}
+    stt_cache.set(cache_key, cached)
+    try:
+        await redis.set(
+            f"stt:{cache_key}",
+            json.dumps(cached, ensure_ascii=False),
+            ex=STT_CACHE_TTL,
+        )
+    except RedisError as e:
+        logger.error(f"Failed to store STT result in Redis: {e}")
+
+
+async def transcribe_and_store(audio_content, user_language, cache_key):
+    text = await transcribe_audio(audio_content, user_language)
+    # Пустой результат может быть следствием временной ошибки STT,
+    # поэтому кешируются только успешные распознавания
+    if text:
+        await store_recognition(cache_key, text)
+    return text
+
+
+async def recognize_audio(audio_content, user_language, audio_hash):
+    cache_key = f"{user_language}:{audio_hash}"
+    cached = await get_cached_recognition(cache_key)
+    if cached is not None:
+        logger.info(f"STT result for audio {audio_hash} taken from cache")
+        return cached["text"], True
+
+    # Одинаковое аудио, пришедшее параллельно, распознается один раз
+    text, joined = await pending_recognitions.run(
+        cache_key,
+        lambda: transcribe_and_store(audio_content, user_language, cache_key),
+    )
+    if joined:
+        logger.info(f"Joined in-flight recognition of audio {audio_hash}")
+    return text, joined
+
+
+async def ingest_message(message_data, user_language):
+    """
+    Единственная точка распознавания входящего сообщения.
+    Аудио транскодируется и распознается один раз, результат
+    кешируется по хешу содержимого.
+    """
+    is_audio = "audio" in message_data and message_data["audio"]
+    if not is_audio:
+        return RecognitionResult(text=message_data.get("text"), is_audio=False)
+
+    audio_hash = None
+    try:
+        audio_content = base64.b64decode(message_data["audio"])
+        logger.info("Successfully decoded base64 audio content.")
+        audio_hash = hashlib.sha256(audio_content).hexdigest()
+        text, from_cache = await recognize_audio(
+            audio_content, user_language, audio_hash
+        )
+        return RecognitionResult(
+            text=text,
+            is_audio=True,
+            audio_hash=audio_hash,
+            from_cache=from_cache,
+        )
+    except Exception as e:
+        logger.error(f"Error processing audio message: {e}")
+        return RecognitionResult(
+            text=None, is_audio=True, audio_hash=audio_hash
+        )
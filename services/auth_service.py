@@ -0,0 +1,221 @@
+import base64
+import hashlib
+import json
+import logging
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from aioredis.exceptions import RedisError
+
+from utils import metrics
+from utils.config import (
+    AUTH_SERVER_URL,
+    AUTH_REVERIFY_INTERVAL,
+    AUTH_CACHE_TTL,
+    AUTH_NEGATIVE_CACHE_TTL,
+    AUTH_CACHE_MAX_SIZE,
+    AUTH_CACHE_USE_REDIS,
+)
+from utils.http_client import get_http_client
+from utils.redis_client import redis
+from utils.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Кеш результатов проверки токенов, ключ - sha256 от токена
+token_cache = TTLCache("auth_tokens", AUTH_CACHE_MAX_SIZE, AUTH_CACHE_TTL)
+
+# Значение в кеше для заведомо невалидного токена
+INVALID_TOKEN = {"valid": False}
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+async def request_token_verification(token):
+    """
+    Проверяет токен на сервере авторизации.
+    Возвращает данные пользователя, INVALID_TOKEN при отказе сервера
+    авторизации или None, если проверку выполнить не удалось.
+    """
+    try:
+        headers = {"Authorization": f"Bearer {token}"}
+        client = get_http_client()
+        response = await client.get(AUTH_SERVER_URL, headers=headers)
+        if response.status_code == 200:
+            return response.json()
+        elif response.status_code in (401, 403):
+            return INVALID_TOKEN
+        else:
+            logger.error(
+                f"Auth server returned status code {response.status_code}"
+            )
+            return None
+    except Exception as e:
+        logger.error(f"Error verifying token: {e}")
+        return None
+
+
+def get_verification_ttl(token, result):
+    if result == INVALID_TOKEN:
+        return AUTH_NEGATIVE_CACHE_TTL
+    # Положительный результат не должен пережить сам токен
+    ttl = AUTH_CACHE_TTL
+    expires_at = get_token_expiry(token)
+    if expires_at is not None:
+        ttl = min(ttl, int(expires_at - time.time()))
+    return ttl
+
+
+async def get_cached_verification(token_hash, token):
+    cached = token_cache.get(token_hash)
+    if cached is not None:
+        return cached
+
+    if AUTH_CACHE_USE_REDIS:
+        try:
+            cached = await redis.get(f"auth_token:{token_hash}")
+            if cached:
+                cached = json.loads(cached)
+                ttl = get_verification_ttl(token, cached)
+                if ttl <= 0:
+                    return None
+                token_cache.set(token_hash, cached, ttl)
+                metrics.increment("auth_cache_redis_hits")
+                return cached
+        except (RedisError, ValueError) as e:
+            logger.error(f"Failed to read token verification from Redis: {e}")
+    return None
+
+
+async def store_verification(token_hash, result, ttl):
+    token_cache.set(token_hash, result, ttl)
+
+    if AUTH_CACHE_USE_REDIS:
+        try:
+            await redis.set(
+                f"auth_token:{token_hash}",
+                json.dumps(result, ensure_ascii=False),
+                ex=ttl,
+            )
+        except RedisError as e:
+            logger.error(f"Failed to store token verification in Redis: {e}")
+
+
+async def verify_token_with_auth_server(token):
+    if not token:
+        return None
+
+    token_hash = hash_token(token)
+    cached = await get_cached_verification(token_hash, token)
+    if cached is not None:
+        metrics.increment("auth_cache_hits")
+        return None if cached == INVALID_TOKEN else cached
+
+    metrics.increment("auth_cache_misses")
+    result = await request_token_verification(token)
+    if result is None:
+        # Ошибки сети и 5xx не кешируются
+        return None
+
+    ttl = get_verification_ttl(token, result)
+    if ttl > 0:
+        await store_verification(token_hash, result, ttl)
+    return None if result == INVALID_TOKEN else result
+
+
+def get_token_expiry(token):
+    """
+    Возвращает время истечения (exp) из payload JWT.
+    Подпись не проверяется: значение используется только для того,
+    чтобы понять, когда токен нужно проверить повторно.
+    """
+    try:
+        payload_segment = token.split(".")[1]
+        padded = payload_segment + "=" * (-len(payload_segment) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded))
+        exp = payload.get("exp")
+        return float(exp) if exp is not None else None
+    except Exception:
+        return None
+
+
+class AuthSession:
+    """
+    Authentication state bound to a single WebSocket connection.
+
+    The token is verified against the auth server once and the resolved
+    user_id is reused for the following frames. Verification is repeated
+    only when the client presents a different token, when the token
+    expires or when the reverify interval has elapsed.
+    """
+
+    def __init__(self, reverify_interval=AUTH_REVERIFY_INTERVAL):
+        self.reverify_interval = reverify_interval
+        self.token = None
+        self.user_id = None
+        self.verified_at = None
+        self.expires_at = None
+
+    @property
+    def is_authenticated(self):
+        return self.user_id is not None
+
+    def reset(self):
+        self.token = None
+        self.user_id = None
+        self.verified_at = None
+        self.expires_at = None
+
+    def needs_verification(self, token):
+        if not self.is_authenticated or token != self.token:
+            return True
+        now = time.time()
+        if self.expires_at is not None and now >= self.expires_at:
+            return True
+        if (
+            self.reverify_interval
+            and now - self.verified_at >= self.reverify_interval
+        ):
+            return True
+        return False
+
+    async def authenticate(self, token=None):
+        token = token or self.token
+        if not token:
+            return None
+
+        if not self.needs_verification(token):
+            return self.user_id
+
+        user_data = await verify_token_with_auth_server(token)
+        if not user_data:
+            self.reset()
+            return None
+
+        self.token = token
+        self.user_id = user_data["result"]["phone"]
+        self.verified_at = time.time()
+        self.expires_at = get_token_expiry(token)
+        logger.info(f"Connection authenticated for user {self.user_id}")
+        return self.user_id
+
+
+def get_connection_token(websocket, path):
+    """
+    Извлекает токен из заголовка Authorization или из параметра
+    token в URL при установке соединения.
+    """
+    try:
+        authorization = websocket.request_headers.get("Authorization")
+        if authorization and authorization.lower().startswith("bearer "):
+            return authorization[len("bearer ") :].strip()
+    except Exception as e:
+        logger.warning(f"Failed to read Authorization header: {e}")
+
+    if path and "?" in path:
+        token = parse_qs(urlsplit(path).query).get("token")
+        if token:
+            return token[0]
+    return None
@@ -0,0 +1,341 @@
+import asyncio
+import json
+import logging
+import uuid
+
+from aioredis.exceptions import RedisError
+from openai import AsyncOpenAI
+
+from services.assistant_reply import (
+    AssistantReply,
+    ReplyDeltaFilter,
+    STRUCTURED_OUTPUT_TOOLS,
+    STRUCTURED_OUTPUT_INSTRUCTIONS,
+    apply_tool_calls,
+    forward_delta,
+    parse_assistant_reply,
+)
+from utils import metrics
+from utils.config import (
+    OPENAI_API_KEY,
+    ASSISTANT_VERSION_TTL,
+    ASSISTANT_STRUCTURED_OUTPUT,
+    CHAT_COMPLETIONS_ASSISTANTS,
+    CHAT_COMPLETIONS_MODEL,
+    CHAT_HISTORY_MAX_MESSAGES,
+    CHAT_HISTORY_KEEP_MESSAGES,
+    CHAT_HISTORY_TTL,
+    CHAT_SUMMARY_MODEL,
+)
+from utils.redis_client import redis
+from utils.ttl_cache import TTLCache
+
+client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+logger = logging.getLogger(__name__)
+
+# Префикс тредов, история которых хранится у нас, а не в OpenAI
+LOCAL_THREAD_PREFIX = "chat_"
+
+SUMMARY_PROMPT = (
+    "Кратко перескажи диалог ниже: какие вопросы уже заданы и какие "
+    "ответы дал пользователь. Сохрани все факты, нужные для продолжения "
+    "анкеты."
+)
+
+# Модель и инструкции ассистентов; перечитываются раз в
+# ASSISTANT_VERSION_TTL секунд, чтобы подхватывать изменения
+assistant_configs = TTLCache("assistant_configs", 16, ASSISTANT_VERSION_TTL)
+
+
+def uses_chat_completions(assistant_id):
+    return assistant_id in CHAT_COMPLETIONS_ASSISTANTS
+
+
+def is_local_thread(thread_id):
+    return bool(thread_id) and thread_id.startswith(LOCAL_THREAD_PREFIX)
+
+
+def new_local_thread_id():
+    return f"{LOCAL_THREAD_PREFIX}{uuid.uuid4().hex}"
+
+
+def history_key(thread_id):
+    return f"chat_history:{thread_id}"
+
+
+def summary_key(thread_id):
+    return f"chat_summary:{thread_id}"
+
+
+async def get_assistant_config(assistant_id):
+    config = assistant_configs.get(assistant_id)
+    if config is not None:
+        return config
+    assistant = await client.beta.assistants.retrieve(assistant_id)
+    config = {
+        "model": CHAT_COMPLETIONS_MODEL or assistant.model,
+        "instructions": assistant.instructions or "",
+        "temperature": assistant.temperature,
+        "tools": [
+            tool.model_dump(exclude_none=True) for tool in assistant.tools
+        ],
+    }
+    assistant_configs.set(assistant_id, config)
+    return config
+
+
+async def load_history(thread_id):
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.get(summary_key(thread_id))
+            pipe.lrange(history_key(thread_id), 0, -1)
+            summary, history = await pipe.execute()
+    except RedisError as e:
+        logger.error(f"Failed to load chat history for {thread_id}: {e}")
+        return None, []
+    if isinstance(summary, bytes):
+        summary = summary.decode("utf-8")
+    return summary, [json.loads(message) for message in history]
+
+
+async def append_messages(thread_id, *messages):
+    """
+    Дописывает сообщения в историю треда. Возвращает длину истории.
+    """
+    key = history_key(thread_id)
+    try:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(
+                key,
+                *(json.dumps(m, ensure_ascii=False) for m in messages),
+            )
+            pipe.expire(key, CHAT_HISTORY_TTL)
+            pipe.expire(summary_key(thread_id), CHAT_HISTORY_TTL)
+            length, _, _ = await pipe.execute()
+        return length
+    except RedisError as e:
+        logger.error(f"Failed to append chat history for {thread_id}: {e}")
+        return 0
+
+
+async def summarize_history(thread_id):
+    """
+    Сворачивает старую часть истории в краткое содержание, оставляя
+    последние CHAT_HISTORY_KEEP_MESSAGES сообщений как есть.
+    """
+    lock_key = f"chat_summary_lock:{thread_id}"
+    try:
+        if not await redis.set(lock_key, "1", nx=True, ex=60):
+            return
+    except RedisError as e:
+        logger.error(f"Failed to lock chat summary for {thread_id}: {e}")
+        return
+
+    try:
+        summary, history = await load_history(thread_id)
+        cut = max(len(history) - CHAT_HISTORY_KEEP_MESSAGES, 0)
+        # Ответ функции не отделяется от вызова, к которому относится
+        while cut < len(history) and history[cut]["role"] == "tool":
+            cut += 1
+        old_messages = history[:cut]
+        if not old_messages:
+            return
+
+        dialog = "\n".join(
+            f"{message['role']}: {message['content']}"
+            for message in old_messages
+            if message.get("content") and message["role"] != "tool"
+        )
+        if summary:
+            dialog = f"Ранее: {summary}\n{dialog}"
+
+        completion = await client.chat.completions.create(
+            model=CHAT_SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": dialog},
+            ],
+        )
+        new_summary = completion.choices[0].message.content or ""
+
+        # Новые сообщения дописываются только в конец списка, поэтому
+        # обрезка по числу свернутых сообщений их не затрагивает
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.set(summary_key(thread_id), new_summary, ex=CHAT_HISTORY_TTL)
+            pipe.ltrim(history_key(thread_id), len(old_messages), -1)
+            await pipe.execute()
+        metrics.increment("chat_history_summaries")
+        logger.info(
+            f"Summarized {len(old_messages)} messages of thread {thread_id}"
+        )
+    except Exception as e:
+        logger.error(f"Failed to summarize chat history for {thread_id}: {e}")
+    finally:
+        try:
+            await redis.delete(lock_key)
+        except RedisError as e:
+            logger.error(f"Failed to unlock chat summary for {thread_id}: {e}")
+
+
+def build_assistant_messages(raw_text, tool_calls):
+    """
+    Сообщения истории для ответа ассистента: вызовы функций сохраняются
+    вместе с ответами на них, иначе следующий запрос будет отклонен.
+    """
+    if not tool_calls:
+        return [{"role": "assistant", "content": raw_text}]
+
+    messages = [
+        {
+            "role": "assistant",
+            "content": raw_text,
+            "tool_calls": [
+                {
+                    "id": call["id"],
+                    "type": "function",
+                    "function": {
+                        "name": call["name"],
+                        "arguments": call["arguments"],
+                    },
+                }
+                for call in tool_calls
+            ],
+        }
+    ]
+    messages.extend(
+        {"role": "tool", "tool_call_id": call["id"], "content": "ok"}
+        for call in tool_calls
+    )
+    return messages
+
+
+async def append_exchange(thread_id, user_text, assistant_text):
+    await append_messages(
+        thread_id,
+        {"role": "user", "content": user_text},
+        {"role": "assistant", "content": assistant_text},
+    )
+
+
+async def read_completion_stream(stream, assistant_id, delta_filter, on_delta):
+    """
+    Читает потоковый ответ: текст проходит через delta_filter (видимая
+    часть пересылается через on_delta), фрагменты вызовов функций
+    собираются по индексу вызова.
+    """
+    tool_call_parts = {}
+    async for chunk in stream:
+        if chunk.usage is not None:
+            metrics.increment(
+                "chat_completion_tokens",
+                chunk.usage.total_tokens,
+                assistant_id=assistant_id,
+            )
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        for tool_call in delta.tool_calls or []:
+            part = tool_call_parts.setdefault(
+                tool_call.index, {"id": "", "name": "", "arguments": ""}
+            )
+            part["id"] = tool_call.id or part["id"]
+            if tool_call.function is not None:
+                part["name"] += tool_call.function.name or ""
+                part["arguments"] += tool_call.function.arguments or ""
+        if not delta.content:
+            continue
+        visible = delta_filter.feed(delta.content)
+        if on_delta is not None:
+            await forward_delta(on_delta, visible)
+    return tool_call_parts
+
+
+async def process_question(
+    question, thread_id=None, assistant_id=None, on_delta=None
+):
+    """
+    Аналог openai_service.process_question на Chat Completions: один
+    потоковый запрос вместо создания сообщения, run, опроса статуса и
+    чтения сообщений. История диалога хранится в Redis.
+    """
+    if not thread_id:
+        thread_id = new_local_thread_id()
+        logger.info(f"New local thread created with ID: {thread_id}")
+
+    try:
+        config = await get_assistant_config(assistant_id)
+        summary, history = await load_history(thread_id)
+
+        instructions = config["instructions"]
+        request_options = {}
+        if ASSISTANT_STRUCTURED_OUTPUT:
+            instructions = (
+                f"{instructions}\n\n{STRUCTURED_OUTPUT_INSTRUCTIONS}"
+            )
+            request_options["tools"] = STRUCTURED_OUTPUT_TOOLS
+
+        messages = [{"role": "system", "content": instructions}]
+        if summary:
+            messages.append(
+                {
+                    "role": "system",
+                    "content": f"Краткое содержание начала диалога: {summary}",
+                }
+            )
+        messages.extend(history)
+        messages.append({"role": "user", "content": question})
+
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        delta_filter = ReplyDeltaFilter()
+        stream = await client.chat.completions.create(
+            model=config["model"],
+            messages=messages,
+            temperature=config["temperature"],
+            stream=True,
+            stream_options={"include_usage": True},
+            **request_options,
+        )
+        try:
+            tool_call_parts = await read_completion_stream(
+                stream, assistant_id, delta_filter, on_delta
+            )
+        except asyncio.CancelledError:
+            # Закрытие соединения останавливает генерацию на стороне OpenAI
+            await asyncio.shield(stream.close())
+            metrics.increment(
+                "chat_completions_cancelled", assistant_id=assistant_id
+            )
+            raise
+        if on_delta is not None:
+            await forward_delta(on_delta, delta_filter.flush())
+
+        metrics.observe(
+            "chat_completion_seconds",
+            loop.time() - started_at,
+            assistant_id=assistant_id,
+        )
+
+        raw_text = delta_filter.text.strip()
+        if not raw_text and not tool_call_parts:
+            logger.error("Chat completion returned an empty reply.")
+            reply_text = "Не удалось получить ответ от ассистента1."
+            return reply_text, thread_id, AssistantReply(text=reply_text)
+
+        tool_calls = [tool_call_parts[i] for i in sorted(tool_call_parts)]
+        length = await append_messages(
+            thread_id,
+            {"role": "user", "content": question},
+            *build_assistant_messages(raw_text, tool_calls),
+        )
+        if length > CHAT_HISTORY_MAX_MESSAGES:
+            asyncio.create_task(summarize_history(thread_id))
+
+        reply = parse_assistant_reply(raw_text)
+        apply_tool_calls(
+            reply, [(call["name"], call["arguments"]) for call in tool_calls]
+        )
+        return reply.text, thread_id, reply
+    except Exception as e:
+        logger.error(f"Error in chat completions process_question: {e}")
+        return "Произошла ошибка при обработке вопроса.", thread_id, None
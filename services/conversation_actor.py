@@ -0,0 +1,202 @@
+import asyncio
+import logging
+
+from utils import metrics
+from utils.config import (
+    CANCEL_SUPERSEDED_TURNS,
+    MESSAGE_COALESCE_WINDOW,
+    CONVERSATION_ACTOR_IDLE_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Бакеты гистограммы числа сообщений, объединенных в один ход
+COALESCED_MESSAGES_BUCKETS = (1, 2, 3, 5, 10)
+
+
+class ConversationActor:
+    """
+    Processes one user's messages strictly in order.
+
+    Every message is accepted (recognized, saved, acknowledged) on its own,
+    but the reply is produced per turn: messages that arrive within
+    MESSAGE_COALESCE_WINDOW of each other or while a turn is running are
+    answered by a single GPT request. A superseded turn is cancelled and
+    its messages are answered together with the new ones, but only until
+    the turn is committed (GPT has answered): after that it always runs
+    to completion and new messages wait for the next turn. The actor
+    exits after CONVERSATION_ACTOR_IDLE_TIMEOUT seconds without messages.
+    """
+
+    def __init__(self, user_id, respond, on_exit):
+        self.user_id = user_id
+        self.respond = respond
+        self.on_exit = on_exit
+        self.mailbox = asyncio.Queue()
+        # Принятые сообщения без ответа: пары (соединение, сообщение)
+        self.pending = []
+        self.turn = None
+        self.turn_committed = False
+        self.task = asyncio.create_task(self.run())
+
+    def post(self, connection, accept, release=None):
+        """
+        release вызывается, если сообщение будет отброшено, не дойдя до
+        приема (соединение закрылось, пока сообщение ждало в очереди).
+        """
+        self.mailbox.put_nowait((connection, accept, release))
+        if (
+            CANCEL_SUPERSEDED_TURNS
+            and self.turn is not None
+            and not self.turn.done()
+        ):
+            self.cancel_turn("superseded")
+
+    def commit_turn(self):
+        self.turn_committed = True
+
+    def cancel_turn(self, reason):
+        """
+        Отменяет текущий ход, если ответ на него еще не получен.
+        Возвращает True, если ход отменен.
+        """
+        if self.turn_committed:
+            metrics.increment("turns_cancel_skipped", reason=reason)
+            return False
+        self.turn.cancel()
+        metrics.increment("turns_cancelled", reason=reason)
+        logger.info(f"Turn of user {self.user_id} cancelled: {reason}")
+        return True
+
+    async def disconnect(self, connection):
+        """
+        Соединение закрыто: его сообщения без ответа отбрасываются,
+        а ход, который на них отвечает, отменяется.
+        """
+        queued = []
+        dropped = []
+        while not self.mailbox.empty():
+            envelope = self.mailbox.get_nowait()
+            if envelope[0] is connection:
+                dropped.append(envelope)
+            else:
+                queued.append(envelope)
+        for envelope in queued:
+            self.mailbox.put_nowait(envelope)
+        for _, _, release in dropped:
+            if release is not None:
+                await release()
+
+        has_pending = any(c is connection for c, _ in self.pending)
+        self.pending = [(c, m) for c, m in self.pending if c is not connection]
+        turn = self.turn
+        if has_pending and turn is not None and not turn.done():
+            if self.cancel_turn("disconnected"):
+                await asyncio.wait({turn})
+
+    async def accept(self, envelope):
+        connection, accept, _ = envelope
+        message = await accept()
+        if message is not None:
+            self.pending.append((connection, message))
+
+    async def collect(self):
+        """
+        Принимает сообщения, пришедшие в течение окна объединения.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + MESSAGE_COALESCE_WINDOW
+        while True:
+            # Уже пришедшие сообщения принимаются и при нулевом окне
+            if not self.mailbox.empty():
+                await self.accept(self.mailbox.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                envelope = await asyncio.wait_for(
+                    self.mailbox.get(), remaining
+                )
+            except asyncio.TimeoutError:
+                return
+            await self.accept(envelope)
+
+    async def run_turn(self):
+        messages = [message for _, message in self.pending]
+        metrics.observe(
+            "coalesced_messages",
+            len(messages),
+            buckets=COALESCED_MESSAGES_BUCKETS,
+        )
+        self.turn_committed = False
+        self.turn = asyncio.create_task(
+            self.respond(messages, self.commit_turn)
+        )
+        try:
+            await asyncio.wait({self.turn})
+        except asyncio.CancelledError:
+            # Ход, на который уже получен ответ, доводится до конца
+            if not self.turn_committed:
+                self.turn.cancel()
+            await asyncio.wait({self.turn})
+            raise
+
+        # Отмененный ход ответит на свои сообщения вместе со следующими
+        if not self.turn.cancelled():
+            self.pending = []
+        self.turn = None
+
+    async def run(self):
+        try:
+            while True:
+                if not self.pending:
+                    try:
+                        envelope = await asyncio.wait_for(
+                            self.mailbox.get(),
+                            CONVERSATION_ACTOR_IDLE_TIMEOUT,
+                        )
+                    except asyncio.TimeoutError:
+                        if self.mailbox.empty():
+                            break
+                        continue
+                    await self.accept(envelope)
+
+                await self.collect()
+                if self.pending:
+                    await self.run_turn()
+        except Exception as e:
+            logger.error(f"Conversation actor of {self.user_id} failed: {e}")
+        finally:
+            self.on_exit(self)
+
+
+class ConversationActorRegistry:
+    """
+    One ConversationActor per user with queued or in-flight messages.
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self._actors = {}
+
+    def __len__(self):
+        return len(self._actors)
+
+    def post(self, user_id, connection, accept, release=None):
+        actor = self._actors.get(user_id)
+        if actor is None or actor.task.done():
+            actor = ConversationActor(user_id, self.respond, self.forget)
+            self._actors[user_id] = actor
+            metrics.set_gauge("conversation_actors", len(self._actors))
+        actor.post(connection, accept, release)
+
+    async def disconnect(self, user_id, connection):
+        actor = self._actors.get(user_id)
+        if actor is not None:
+            await actor.disconnect(connection)
+
+    def forget(self, actor):
+        if self._actors.get(actor.user_id) is actor:
+            del self._actors[actor.user_id]
+        metrics.set_gauge("conversation_actors", len(self._actors))
@@ -1,11 +1,19 @@
+import logging
+
 from constants.assistants_answers_var import (
     RegistrationQuestions,
     DailySurveyQuestions,
 )
 from utils.config import ASSISTANT2_ID, ASSISTANT_ID
 
+logger = logging.getLogger(__name__)
+
 
-def extract_marker_and_options(question_text, assistant_id):
+def extract_question_marker(question_text):
+    """
+    Отделяет маркер вида [QUESTION_n] от текста вопроса.
+    Возвращает текст без маркера и сам маркер (или None).
+    """
     marker_start = question_text.find("[QUESTION_")
     if marker_start != -1:
         marker_end = question_text.find("]", marker_start)
@@ -13,29 +21,29 @@ def extract_marker_and_options(question_text, assistant_id):
             question_marker = question_text[
                 marker_start + 1 : marker_end
             ].strip()
-            print(f"Extracted marker: {question_marker}")  # Отладочный вывод
+            logger.debug(f"Extracted marker: {question_marker}")
 
             question_text = question_text[:marker_start].strip()
-
-            if assistant_id == ASSISTANT2_ID:
-                print(
-                    f"Looking in RegistrationQuestions for {question_marker}"
-                )
-                options_data = RegistrationQuestions.__members__.get(
-                    question_marker
-                )
-                if options_data:
-                    options_data = options_data.value
-            elif assistant_id == ASSISTANT_ID:
-                print(f"Looking in DailySurveyQuestions for {question_marker}")
-                options_data = DailySurveyQuestions.__members__.get(
-                    question_marker
-                )
-                if options_data:
-                    options_data = options_data.value
-            else:
-                options_data = None
-
-            return question_text, options_data
+            return question_text, question_marker
 
     return question_text, None
+
+
+def get_question_options(question_marker, assistant_id):
+    if not question_marker:
+        return None
+
+    if assistant_id == ASSISTANT2_ID:
+        logger.debug(f"Looking in RegistrationQuestions for {question_marker}")
+        options_data = RegistrationQuestions.__members__.get(question_marker)
+        if options_data:
+            options_data = options_data.value
+    elif assistant_id == ASSISTANT_ID:
+        logger.debug(f"Looking in DailySurveyQuestions for {question_marker}")
+        options_data = DailySurveyQuestions.__members__.get(question_marker)
+        if options_data:
+            options_data = options_data.value
+    else:
+        options_data = None
+
+    return options_data
@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import json
+import logging
+
+from aioredis.exceptions import RedisError
+
+from services.openai_service import (
+    AssistantReply,
+    append_exchange_to_thread,
+    client,
+)
+from utils import metrics
+from utils.config import (
+    GREETING_CACHE_ENABLED,
+    GREETING_CACHE_TTL,
+    ASSISTANT_VERSION_TTL,
+)
+from utils.redis_client import redis
+from utils.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Первое сообщение, которым открывается каждая сессия
+GREETING_PROMPT = "Здравствуйте"
+
+# Версии конфигурации ассистентов; перечитываются раз в
+# ASSISTANT_VERSION_TTL секунд
+assistant_versions = TTLCache("assistant_versions", 16, ASSISTANT_VERSION_TTL)
+
+greeting_local_cache = TTLCache("greetings", 16, GREETING_CACHE_TTL)
+
+
+async def get_assistant_version(assistant_id):
+    """
+    Хеш конфигурации ассистента (модель, инструкции, инструменты).
+    Меняется при любом изменении ассистента, поэтому входит в ключ кеша
+    приветствия.
+    """
+    version = assistant_versions.get(assistant_id)
+    if version is not None:
+        return version
+    try:
+        assistant = await client.beta.assistants.retrieve(assistant_id)
+    except Exception as e:
+        logger.error(f"Failed to retrieve assistant {assistant_id}: {e}")
+        return None
+
+    config = assistant.model_dump(exclude={"created_at"})
+    version = hashlib.sha256(
+        json.dumps(config, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()[:16]
+    assistant_versions.set(assistant_id, version)
+    return version
+
+
+def greeting_cache_key(assistant_id, language, version):
+    return f"greeting:{version}:{assistant_id}:{language}"
+
+
+async def get_cached_greeting(assistant_id, language):
+    """
+    Возвращает сохраненный первый ответ ассистента для языка:
+    {"text", "reply", "marker"}, где text - текст для пользователя
+    (уже переведенный), а reply - исходный ответ ассистента на русском.
+    """
+    if not GREETING_CACHE_ENABLED or not assistant_id:
+        return None
+
+    version = await get_assistant_version(assistant_id)
+    if version is None:
+        return None
+    cache_key = greeting_cache_key(assistant_id, language, version)
+
+    greeting = greeting_local_cache.get(cache_key)
+    if greeting is None:
+        try:
+            cached = await redis.get(cache_key)
+        except RedisError as e:
+            logger.error(f"Failed to read greeting from Redis: {e}")
+            cached = None
+        if cached:
+            greeting = json.loads(cached)
+            greeting_local_cache.set(cache_key, greeting)
+
+    if greeting is None:
+        metrics.increment("greeting_cache_misses", language=language)
+        return None
+    metrics.increment("greeting_cache_hits", language=language)
+    return greeting
+
+
+async def store_greeting(assistant_id, language, response_text, reply):
+    if not GREETING_CACHE_ENABLED or not (response_text and reply):
+        return
+    # Кешируется только настоящий первый вопрос: ответ завершенного run
+    # с маркером, а не текст ошибки или итог анкеты
+    if not reply.completed or not reply.marker or reply.is_final:
+        return
+
+    version = await get_assistant_version(assistant_id)
+    if version is None:
+        return
+    cache_key = greeting_cache_key(assistant_id, language, version)
+
+    greeting = {
+        "text": response_text,
+        "reply": reply.text,
+        "marker": reply.marker,
+    }
+    greeting_local_cache.set(cache_key, greeting)
+    try:
+        await redis.set(
+            cache_key,
+            json.dumps(greeting, ensure_ascii=False),
+            ex=GREETING_CACHE_TTL,
+        )
+        logger.info(f"Greeting cached for {assistant_id} ({language})")
+    except RedisError as e:
+        logger.error(f"Failed to store greeting in Redis: {e}")
+
+
+def seed_thread_with_greeting(thread_id, greeting):
+    """
+    Дописывает приветствие в новый тред в фоне, чтобы следующие
+    ответы ассистента продолжали анкету с нужного места.
+    """
+    reply_text = greeting["reply"]
+    if greeting["marker"]:
+        reply_text = f"{reply_text} [{greeting['marker']}]"
+    asyncio.create_task(
+        append_exchange_to_thread(thread_id, GREETING_PROMPT, reply_text)
+    )
+    return AssistantReply(
+        text=greeting["reply"], marker=greeting["marker"], completed=True
+    )
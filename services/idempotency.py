@@ -0,0 +1,143 @@
+import asyncio
+import json
+import logging
+
+from aioredis.exceptions import RedisError
+
+from utils import metrics
+from utils.config import IDEMPOTENCY_TTL, IDEMPOTENCY_PENDING_TTL
+from utils.redis_client import redis
+
+logger = logging.getLogger(__name__)
+
+# Состояния сообщения клиента:
+# pending  - сообщение принимается (распознавание, запись в базу)
+# accepted - сообщение записано в базу, ответ еще не получен
+# answered - ответ записан в базу
+PENDING = "pending"
+ACCEPTED = "accepted"
+ANSWERED = "answered"
+
+# Интервал опроса состояния сообщения, которое еще принимается
+PENDING_POLL_INTERVAL = 0.2
+
+
+def idempotency_key(user_id, front_id):
+    return f"idem:{user_id}:{front_id}"
+
+
+async def claim_message(user_id, front_id):
+    """
+    Атомарно занимает front_id сообщения (SET NX EX). Возвращает None,
+    если сообщение новое и его нужно обработать, иначе сохраненное
+    состояние повтора. Без front_id или при недоступном Redis сообщение
+    обрабатывается как новое.
+    """
+    state = await claim_or_read(user_id, front_id)
+    if state is not None:
+        metrics.increment("duplicate_messages", status=state["status"])
+        logger.info(
+            f"Message {front_id} of user {user_id} is a retry "
+            f"({state['status']})"
+        )
+    return state
+
+
+async def claim_or_read(user_id, front_id):
+    if not front_id:
+        return None
+
+    key = idempotency_key(user_id, front_id)
+    pending = json.dumps({"status": PENDING})
+    try:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.set(key, pending, nx=True, ex=IDEMPOTENCY_PENDING_TTL)
+            pipe.get(key)
+            claimed, stored = await pipe.execute()
+    except RedisError as e:
+        logger.error(f"Failed to claim message {front_id} of {user_id}: {e}")
+        return None
+
+    if claimed or stored is None:
+        return None
+    return json.loads(stored)
+
+
+async def get_state(user_id, front_id):
+    """
+    Текущее состояние сообщения без попытки его занять. None, если
+    состояния нет или Redis недоступен.
+    """
+    if not front_id:
+        return None
+    try:
+        stored = await redis.get(idempotency_key(user_id, front_id))
+    except RedisError as e:
+        logger.error(f"Failed to read state of message {front_id}: {e}")
+        return None
+    return json.loads(stored) if stored is not None else None
+
+
+async def wait_until_resolved(user_id, front_id, timeout):
+    """
+    Ждет, пока оригинал сообщения будет принят (accepted) или отвечен
+    (answered), не дольше timeout секунд. Если оригинал освободил
+    front_id, сообщение занимается заново и возвращается None.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        state = await claim_or_read(user_id, front_id)
+        if state is None or state["status"] != PENDING:
+            return state
+        if loop.time() >= deadline:
+            return state
+        await asyncio.sleep(PENDING_POLL_INTERVAL)
+
+
+async def save_state(user_id, front_id, state, ttl):
+    if not front_id:
+        return
+    try:
+        await redis.set(
+            idempotency_key(user_id, front_id),
+            json.dumps(state, ensure_ascii=False),
+            ex=ttl,
+        )
+    except RedisError as e:
+        logger.error(f"Failed to save state of message {front_id}: {e}")
+
+
+async def mark_accepted(user_id, front_id, message_id):
+    await save_state(
+        user_id,
+        front_id,
+        {"status": ACCEPTED, "message_id": str(message_id)},
+        IDEMPOTENCY_TTL,
+    )
+
+
+async def mark_answered(user_id, front_id, message_id, reply):
+    """
+    reply: id и created_at ответа, а также поля ответа, которые не
+    хранятся в базе (варианты ответа на вопрос).
+    """
+    await save_state(
+        user_id,
+        front_id,
+        {"status": ANSWERED, "message_id": str(message_id), "reply": reply},
+        IDEMPOTENCY_TTL,
+    )
+
+
+async def release_message(user_id, front_id):
+    """
+    Освобождает front_id, если сообщение не удалось принять: повтор
+    клиента будет обработан заново.
+    """
+    if not front_id:
+        return
+    try:
+        await redis.delete(idempotency_key(user_id, front_id))
+    except RedisError as e:
+        logger.error(f"Failed to release message {front_id}: {e}")
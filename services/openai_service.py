@@ -1,15 +1,134 @@
 import asyncio
 import logging
+import random
 from openai import AsyncOpenAI
-from collections import defaultdict
+from contextlib import asynccontextmanager
+from services import chat_completions_service
+from services.assistant_reply import (
+    AssistantReply,
+    ReplyDeltaFilter,
+    STRUCTURED_OUTPUT_TOOLS,
+    STRUCTURED_OUTPUT_INSTRUCTIONS,
+    apply_tool_calls,
+    forward_delta,
+    parse_assistant_reply,
+)
 from services.yandex_service import translate_text
-from utils.config import OPENAI_API_KEY
+from utils import metrics
+from utils.config import (
+    OPENAI_API_KEY,
+    RUN_POLL_INITIAL_INTERVAL,
+    RUN_POLL_MAX_INTERVAL,
+    RUN_POLL_BACKOFF,
+    RUN_POLL_JITTER,
+    OPENAI_RUN_TIMEOUT,
+    OPENAI_RUN_MESSAGES_LIMIT,
+    ASSISTANT_STRUCTURED_OUTPUT,
+    RUN_CANCEL_TIMEOUT,
+)
 
 client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 logger = logging.getLogger(__name__)
 
-# Словарь для хранения очередей запросов для каждого треда
-thread_queues = defaultdict(asyncio.Queue)
+# Бакеты гистограммы числа опросов статуса run
+RUN_POLL_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+# Бакеты гистограммы длины очереди к одному треду
+THREAD_QUEUE_DEPTH_BUCKETS = (1, 2, 3, 5, 10)
+
+# Статусы, при которых run еще не завершен
+ACTIVE_RUN_STATUSES = ("queued", "in_progress", "cancelling")
+
+# Скользящие средние длительности и числа токенов завершенных run;
+# по ним оценивается, сколько сэкономила отмена run
+completed_run_stats = {"seconds": None, "completion_tokens": None}
+RUN_STATS_SMOOTHING = 0.1
+
+
+def get_message_text(message):
+    return "".join(
+        content.text.value
+        for content in message.content
+        if getattr(content, "type", None) == "text"
+    )
+
+
+def build_reply_from_messages(messages, run_id=None):
+    """
+    Собирает ответ из сообщений ассистента одного run
+    (сообщения передаются в хронологическом порядке).
+    """
+    raw_text = "\n\n".join(
+        get_message_text(msg) for msg in messages if msg.role == "assistant"
+    ).strip()
+    if not raw_text:
+        return None
+    return parse_assistant_reply(raw_text, run_id)
+
+
+class ThreadLockRegistry:
+    """
+    Guarantees at most one active run per OpenAI thread.
+
+    Each thread gets an asyncio.Lock that lives only while somebody holds
+    it or waits for it, so the registry does not grow with the number of
+    threads ever seen. Queue depth and wait time are reported to metrics.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self.waiting = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def queue_depth(self, thread_id):
+        entry = self._entries.get(thread_id)
+        return entry["users"] if entry else 0
+
+    @asynccontextmanager
+    async def acquire(self, thread_id):
+        entry = self._entries.get(thread_id)
+        if entry is None:
+            entry = {"lock": asyncio.Lock(), "users": 0}
+            self._entries[thread_id] = entry
+        entry["users"] += 1
+        metrics.observe(
+            "openai_thread_queue_depth",
+            entry["users"],
+            buckets=THREAD_QUEUE_DEPTH_BUCKETS,
+        )
+
+        queued_at = asyncio.get_running_loop().time()
+        self.waiting += 1
+        self.update_gauges()
+        is_waiting = True
+        try:
+            async with entry["lock"]:
+                self.waiting -= 1
+                is_waiting = False
+                self.update_gauges()
+                metrics.observe(
+                    "openai_thread_wait_seconds",
+                    asyncio.get_running_loop().time() - queued_at,
+                )
+                yield
+        finally:
+            if is_waiting:
+                # Ожидание прервано (например, отменой задачи)
+                self.waiting -= 1
+            entry["users"] -= 1
+            if entry["users"] == 0:
+                self._entries.pop(thread_id, None)
+            self.update_gauges()
+
+    def update_gauges(self):
+        metrics.set_gauge("openai_thread_locks", len(self._entries))
+        metrics.set_gauge("openai_thread_waiters", self.waiting)
+
+
+# Не более одного активного run на тред
+thread_locks = ThreadLockRegistry()
 
 
 async def get_new_thread_id():
@@ -21,24 +140,425 @@ async def get_new_thread_id():
         return None
 
 
-async def process_queue(thread_id):
-    while not thread_queues[thread_id].empty():
-        task = await thread_queues[thread_id].get()
-        try:
-            result = await task()
-            thread_queues[thread_id].task_done()
-            return result
-        except Exception as e:
-            logger.error(f"Error processing task in queue: {e}")
-            thread_queues[thread_id].task_done()
+async def append_exchange_to_thread(thread_id, user_text, assistant_text):
+    """
+    Добавляет в тред пару сообщений (ответ пользователя и реплику
+    ассистента), сформированную без запуска run, чтобы следующие
+    ответы GPT учитывали контекст.
+    """
+    if isinstance(thread_id, bytes):
+        thread_id = thread_id.decode("utf-8")
+    try:
+        async with thread_locks.acquire(thread_id):
+            if chat_completions_service.is_local_thread(thread_id):
+                await chat_completions_service.append_exchange(
+                    thread_id, user_text, assistant_text
+                )
+                return
+            await client.beta.threads.messages.create(
+                thread_id=thread_id, role="user", content=user_text
+            )
+            await client.beta.threads.messages.create(
+                thread_id=thread_id, role="assistant", content=assistant_text
+            )
+    except Exception as e:
+        logger.error(f"Failed to append exchange to thread {thread_id}: {e}")
+
+
+def update_average(name, value):
+    average = completed_run_stats[name]
+    if average is None:
+        completed_run_stats[name] = value
+    else:
+        completed_run_stats[name] = average + RUN_STATS_SMOOTHING * (
+            value - average
+        )
+
+
+def record_completed_run(run, seconds):
+    update_average("seconds", seconds)
+    if run.usage is not None:
+        update_average("completion_tokens", run.usage.completion_tokens)
+
+
+async def cancel_run(thread_id, run_id, assistant_id, started_at):
+    """
+    Отменяет run прерванного хода и ждет его остановки, чтобы тред был
+    свободен для следующего сообщения. Сэкономленные секунды и токены
+    оцениваются по средним значениям завершенных run. Возвращает run в
+    последнем полученном состоянии или None, если отменить не удалось.
+    """
+    loop = asyncio.get_running_loop()
+    elapsed = loop.time() - started_at
+    try:
+        run = await client.beta.threads.runs.cancel(
+            thread_id=thread_id, run_id=run_id
+        )
+        cancel_deadline = loop.time() + RUN_CANCEL_TIMEOUT
+        while (
+            run.status in ACTIVE_RUN_STATUSES and loop.time() < cancel_deadline
+        ):
+            await asyncio.sleep(RUN_POLL_INITIAL_INTERVAL)
+            run = await client.beta.threads.runs.retrieve(
+                thread_id=thread_id, run_id=run_id
+            )
+    except Exception as e:
+        # Run мог успеть завершиться сам
+        logger.error(f"Failed to cancel run {run_id}: {e}")
+        return None
+
+    logger.info(f"Run {run_id} cancelled with status {run.status}")
+    metrics.increment("openai_runs_cancelled", assistant_id=assistant_id)
+
+    average_seconds = completed_run_stats["seconds"]
+    if average_seconds is not None:
+        metrics.increment(
+            "openai_cancel_saved_seconds", max(average_seconds - elapsed, 0)
+        )
+    average_tokens = completed_run_stats["completion_tokens"]
+    if average_tokens is not None:
+        used_tokens = run.usage.completion_tokens if run.usage else 0
+        metrics.increment(
+            "openai_cancel_saved_tokens", max(average_tokens - used_tokens, 0)
+        )
+    return run
+
+
+async def get_run_options(assistant_id):
+    """
+    Дополнительные параметры run. При структурированном ответе к
+    инструментам ассистента добавляются present_question и submit_result.
+    """
+    if not ASSISTANT_STRUCTURED_OUTPUT:
+        return {}
+
+    config = await chat_completions_service.get_assistant_config(assistant_id)
+    structured_names = {
+        tool["function"]["name"] for tool in STRUCTURED_OUTPUT_TOOLS
+    }
+    tools = [
+        tool
+        for tool in config["tools"]
+        if tool.get("function", {}).get("name") not in structured_names
+    ]
+    return {
+        "tools": tools + STRUCTURED_OUTPUT_TOOLS,
+        "additional_instructions": STRUCTURED_OUTPUT_INSTRUCTIONS,
+    }
+
+
+def get_tool_outputs(tool_calls):
+    # Функциям структурированного ответа нечего возвращать ассистенту
+    return [{"tool_call_id": call.id, "output": "ok"} for call in tool_calls]
+
+
+def get_required_tool_calls(run):
+    return run.required_action.submit_tool_outputs.tool_calls
+
+
+async def stream_run(
+    thread_id, assistant_id, on_delta, run_options, run_state
+):
+    """
+    Запускает run в потоковом режиме и пересылает видимую часть текста
+    через on_delta. Возвращает итоговый статус run, завершенные
+    сообщения ассистента и вызовы функций структурированного ответа.
+    В run_state ({"id": None, "run": None}) записывается id run, как
+    только он создан.
+    """
+    delta_filter = ReplyDeltaFilter()
+    completed_messages = []
+    tool_calls = []
+    run_status = None
+    started_at = asyncio.get_running_loop().time()
+
+    try:
+        stream = await client.beta.threads.runs.create(
+            thread_id=thread_id,
+            assistant_id=assistant_id,
+            stream=True,
+            **run_options,
+        )
+        while stream is not None:
+            run_status, stream = await consume_run_stream(
+                thread_id,
+                stream,
+                on_delta,
+                delta_filter,
+                completed_messages,
+                tool_calls,
+                run_state,
+            )
+    except asyncio.CancelledError:
+        if run_state["id"]:
+            await asyncio.shield(
+                cancel_run(
+                    thread_id, run_state["id"], assistant_id, started_at
+                )
+            )
+        raise
+
+    if run_status == "completed" and run_state["run"] is not None:
+        record_completed_run(
+            run_state["run"], asyncio.get_running_loop().time() - started_at
+        )
+    await forward_delta(on_delta, delta_filter.flush())
+    return run_status, completed_messages, tool_calls
+
+
+async def consume_run_stream(
+    thread_id,
+    stream,
+    on_delta,
+    delta_filter,
+    completed_messages,
+    tool_calls,
+    run_state,
+):
+    """
+    Читает один поток событий run. Возвращает статус run и, если run
+    ждет результатов вызова функций, поток его продолжения.
+    """
+    run_status = None
+    required_run = None
+    async for event in stream:
+        if event.event == "thread.run.created":
+            run_state["id"] = event.data.id
+            logger.info(f"Streaming run created with ID: {event.data.id}")
+        elif event.event == "thread.message.delta":
+            for content in event.data.delta.content or []:
+                if content.type == "text" and content.text.value:
+                    await forward_delta(
+                        on_delta, delta_filter.feed(content.text.value)
+                    )
+        elif event.event == "thread.message.completed":
+            completed_messages.append(event.data)
+        elif event.event in (
+            "thread.run.completed",
+            "thread.run.failed",
+            "thread.run.cancelled",
+            "thread.run.expired",
+            "thread.run.incomplete",
+        ):
+            run_status = event.data.status
+            run_state["run"] = event.data
+            logger.info(f"Streaming run finished with status: {run_status}")
+        elif event.event == "thread.run.requires_action":
+            required_run = event.data
+        elif event.event == "error":
+            logger.error(f"Error event in run stream: {event.data}")
+            run_status = "failed"
+
+    if required_run is None:
+        return run_status, None
+
+    calls = get_required_tool_calls(required_run)
+    tool_calls.extend(
+        (call.function.name, call.function.arguments) for call in calls
+    )
+    next_stream = await client.beta.threads.runs.submit_tool_outputs(
+        thread_id=thread_id,
+        run_id=required_run.id,
+        tool_outputs=get_tool_outputs(calls),
+        stream=True,
+    )
+    return run_status, next_stream
+
+
+async def wait_for_run(thread_id, run, assistant_id, deadline):
+    """
+    Ожидает завершения run, опрашивая статус с растущим интервалом:
+    от RUN_POLL_INITIAL_INTERVAL до RUN_POLL_MAX_INTERVAL со случайным
+    разбросом. По истечении deadline (время цикла событий) run отменяется.
+    """
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+    interval = RUN_POLL_INITIAL_INTERVAL
+    polls = 0
+
+    while run.status in ACTIVE_RUN_STATUSES:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            logger.error(f"Run {run.id} exceeded the deadline, cancelling")
+            metrics.increment("openai_run_timeouts", assistant_id=assistant_id)
+            # Тред освобождается только после остановки run, иначе
+            # следующее сообщение в него будет отклонено
+            cancelled_run = await cancel_run(
+                thread_id, run.id, assistant_id, started_at
+            )
+            if cancelled_run is not None:
+                run = cancelled_run
+            break
+
+        jitter = random.uniform(0, interval * RUN_POLL_JITTER)
+        await asyncio.sleep(min(interval + jitter, remaining))
+        run = await client.beta.threads.runs.retrieve(
+            thread_id=thread_id, run_id=run.id
+        )
+        polls += 1
+        interval = min(interval * RUN_POLL_BACKOFF, RUN_POLL_MAX_INTERVAL)
+        logger.info(f"Run status updated to: {run.status}")
+
+    metrics.observe(
+        "openai_run_polls",
+        polls,
+        buckets=RUN_POLL_BUCKETS,
+        assistant_id=assistant_id,
+    )
+    metrics.observe(
+        "openai_run_seconds",
+        loop.time() - started_at,
+        assistant_id=assistant_id,
+    )
+    return run
 
 
-async def queue_task(thread_id, task):
-    await thread_queues[thread_id].put(task)
-    return await process_queue(thread_id)
+async def complete_run(thread_id, run, assistant_id, deadline):
+    """
+    Доводит run до конечного статуса. Отмену run при прерванном ходе
+    выполняет process_question (abandon_turn).
+    """
+    started_at = asyncio.get_running_loop().time()
+    tool_calls = []
+    run = await wait_for_run(thread_id, run, assistant_id, deadline)
+
+    # Вызовы present_question / submit_result подтверждаются сразу,
+    # их аргументы и есть структурированный ответ
+    while run.status == "requires_action":
+        calls = get_required_tool_calls(run)
+        tool_calls.extend(
+            (call.function.name, call.function.arguments) for call in calls
+        )
+        run = await client.beta.threads.runs.submit_tool_outputs(
+            thread_id=thread_id,
+            run_id=run.id,
+            tool_outputs=get_tool_outputs(calls),
+        )
+        run = await wait_for_run(thread_id, run, assistant_id, deadline)
+
+    if run.status == "completed":
+        record_completed_run(
+            run, asyncio.get_running_loop().time() - started_at
+        )
+    return run, tool_calls
+
+
+async def settled(task):
+    """
+    Результат запроса, начатого до отмены хода, или None, если запроса
+    не было или он завершился ошибкой.
+    """
+    if task is None:
+        return None
+    try:
+        return await task
+    except Exception:
+        return None
+
+
+def create_user_message(thread_id, question):
+    # Запрос доводится до конца и при отмене хода (см. abandon_turn),
+    # иначе сообщение останется в треде без известного id
+    return asyncio.ensure_future(
+        client.beta.threads.messages.create(
+            thread_id=thread_id, role="user", content=question
+        )
+    )
+
+
+async def discard_turn_messages(thread_id, message_task, run_id=None):
+    """
+    Удаляет из треда сообщение пользователя прерванного хода и все, что
+    успел написать его run. Следующий ход отправляет это сообщение
+    заново вместе с новыми, и без удаления оно оказалось бы в треде
+    дважды.
+    """
+    message = await settled(message_task)
+    try:
+        message_ids = []
+        if run_id:
+            run_messages = await client.beta.threads.messages.list(
+                thread_id=thread_id,
+                run_id=run_id,
+                limit=OPENAI_RUN_MESSAGES_LIMIT,
+            )
+            message_ids.extend(m.id for m in run_messages.data)
+        if message is not None:
+            message_ids.append(message.id)
+        for message_id in message_ids:
+            await client.beta.threads.messages.delete(
+                message_id, thread_id=thread_id
+            )
+    except Exception as e:
+        logger.error(f"Failed to discard cancelled turn in {thread_id}: {e}")
+        return
+    logger.info(
+        f"Discarded {len(message_ids)} messages of cancelled turn "
+        f"in {thread_id}"
+    )
+
+
+async def abandon_turn(
+    thread_id, message_task, run_task, run, assistant_id, started_at
+):
+    """
+    Прерванный ход (клиент отключился или прислал новое сообщение):
+    run, даже если отмена пришла во время его создания, отменяется, а
+    сообщения хода удаляются из треда.
+    """
+    if run is None:
+        run = await settled(run_task)
+    if run is not None and run.status in ACTIVE_RUN_STATUSES:
+        await cancel_run(thread_id, run.id, assistant_id, started_at)
+    await discard_turn_messages(
+        thread_id, message_task, run.id if run is not None else None
+    )
 
 
-async def process_question(question, thread_id=None, assistant_id=None):
+async def process_question_streaming(
+    question, thread_id, assistant_id, on_delta
+):
+    message_task = create_user_message(thread_id, question)
+    run_state = {"id": None, "run": None}
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+    try:
+        await asyncio.shield(message_task)
+        # При отмене stream_run сам останавливает run
+        run_status, completed_messages, tool_calls = await stream_run(
+            thread_id,
+            assistant_id,
+            on_delta,
+            await get_run_options(assistant_id),
+            run_state,
+        )
+    except asyncio.CancelledError:
+        await asyncio.shield(
+            discard_turn_messages(thread_id, message_task, run_state["id"])
+        )
+        raise
+    metrics.observe(
+        "openai_run_seconds",
+        loop.time() - started_at,
+        assistant_id=assistant_id,
+    )
+    if run_status != "completed":
+        logger.error(f"Run status is not completed: {run_status}")
+        reply_text = "Не удалось получить ответ от ассистента2."
+        return reply_text, thread_id, AssistantReply(text=reply_text)
+
+    reply = build_reply_from_messages(completed_messages)
+    if reply is None:
+        logger.error("Assistant messages list is empty.")
+        reply_text = "Не удалось получить ответ от ассистента1."
+        return reply_text, thread_id, AssistantReply(text=reply_text)
+    apply_tool_calls(reply, tool_calls)
+    return reply.text, thread_id, reply
+
+
+async def process_question(
+    question, thread_id=None, assistant_id=None, on_delta=None, deadline=None
+):
     if isinstance(thread_id, bytes):
         thread_id = thread_id.decode("utf-8")
     if isinstance(assistant_id, bytes):
@@ -54,69 +574,145 @@ async def process_question(question, thread_id=None, assistant_id=None):
             thread_id = thread.id
             logger.info(f"New thread created with ID: {thread_id}")
 
-        await client.beta.threads.messages.create(
-            thread_id=thread_id, role="user", content=question
-        )
-        run = await client.beta.threads.runs.create(
-            thread_id=thread_id, assistant_id=assistant_id
-        )
-        logger.info(f"Run created with ID: {run.id} and status: {run.status}")
-
-        while run.status in ["queued", "in_progress", "cancelling"]:
-            await asyncio.sleep(1)
-            run = await client.beta.threads.runs.retrieve(
-                thread_id=thread_id, run_id=run.id
+        if on_delta is not None:
+            return await process_question_streaming(
+                question, thread_id, assistant_id, on_delta
             )
-            logger.info(f"Run status updated to: {run.status}")
 
-        if run.status == "completed":
-            messages = await client.beta.threads.messages.list(
-                thread_id=thread_id
+        message_task = create_user_message(thread_id, question)
+        run_task = None
+        run = None
+        started_at = asyncio.get_running_loop().time()
+        try:
+            await asyncio.shield(message_task)
+            run_options = await get_run_options(assistant_id)
+            # id run известен сразу после создания, даже если ход
+            # отменяется во время запроса
+            run_task = asyncio.ensure_future(
+                client.beta.threads.runs.create(
+                    thread_id=thread_id,
+                    assistant_id=assistant_id,
+                    **run_options,
+                )
+            )
+            run = await asyncio.shield(run_task)
+            logger.info(
+                f"Run created with ID: {run.id} and status: {run.status}"
             )
-            logger.info(f"Retrieved messages: {messages.data}")
 
-            if not messages.data:
-                logger.error("No messages were retrieved.")
-                return (
-                    "Не удалось получить ответ от ассистента1.",
-                    thread_id,
-                    messages,
+            if deadline is None:
+                deadline = (
+                    asyncio.get_running_loop().time() + OPENAI_RUN_TIMEOUT
                 )
+            run, tool_calls = await complete_run(
+                thread_id, run, assistant_id, deadline
+            )
 
-            assistant_messages = [
-                msg.content[0].text.value.split("```json")[0]
-                for msg in messages.data
-                if msg.role == "assistant"
-            ]
-            if assistant_messages:
-                return assistant_messages[0], thread_id, messages
-            else:
-                logger.error("Assistant messages list is empty.")
-                return (
-                    "Не удалось получить ответ от ассистента1.",
+            if run.status == "completed":
+                # Только сообщения текущего run, а не весь тред
+                messages = await client.beta.threads.messages.list(
+                    thread_id=thread_id,
+                    run_id=run.id,
+                    order="desc",
+                    limit=OPENAI_RUN_MESSAGES_LIMIT,
+                )
+                logger.info(f"Retrieved {len(messages.data)} messages for run")
+        except asyncio.CancelledError:
+            await asyncio.shield(
+                abandon_turn(
                     thread_id,
-                    messages,
+                    message_task,
+                    run_task,
+                    run,
+                    assistant_id,
+                    started_at,
                 )
-        else:
+            )
+            raise
+
+        if run.status != "completed":
             logger.error(f"Run status is not completed: {run.status}")
-            return "Не удалось получить ответ от ассистента2.", thread_id, run
+            reply_text = "Не удалось получить ответ от ассистента2."
+            return (
+                reply_text,
+                thread_id,
+                AssistantReply(text=reply_text, run_id=run.id),
+            )
+
+        reply = build_reply_from_messages(reversed(messages.data), run.id)
+        if reply is None:
+            logger.error("Assistant messages list is empty.")
+            reply_text = "Не удалось получить ответ от ассистента1."
+            return reply_text, thread_id, AssistantReply(text=reply_text)
+        apply_tool_calls(reply, tool_calls)
+        return reply.text, thread_id, reply
     except Exception as e:
         logger.error(f"Error in process_question: {e}")
         return "Произошла ошибка при обработке вопроса.", thread_id, None
 
 
 async def send_to_gpt(
-    content, thread_id=None, assistant_id=None, target_language="ru"
+    content,
+    thread_id=None,
+    assistant_id=None,
+    target_language="ru",
+    on_delta=None,
+    deadline=None,
 ):
+    """
+    deadline - бюджет хода (utils.deadline.Deadline); run, не успевший
+    завершиться до его истечения, отменяется.
+    """
     if isinstance(thread_id, bytes):
         thread_id = thread_id.decode("utf-8")
     if isinstance(assistant_id, bytes):
         assistant_id = assistant_id.decode("utf-8")
 
+    # Уже начатый диалог продолжается на том бэкенде, где он начат
+    if thread_id:
+        use_chat_completions = chat_completions_service.is_local_thread(
+            thread_id
+        )
+    else:
+        use_chat_completions = chat_completions_service.uses_chat_completions(
+            assistant_id
+        )
+    backend = "chat_completions" if use_chat_completions else "assistants"
+    run_deadline = None
+    if deadline is not None:
+        run_deadline = min(
+            deadline.expires_at,
+            asyncio.get_running_loop().time() + OPENAI_RUN_TIMEOUT,
+        )
+
     async def task():
         try:
-            response_text, new_thread_id, full_response = (
-                await process_question(content, thread_id, assistant_id)
+            loop = asyncio.get_running_loop()
+            started_at = loop.time()
+            if use_chat_completions:
+                request = chat_completions_service.process_question(
+                    content, thread_id, assistant_id, on_delta
+                )
+            else:
+                request = process_question(
+                    content, thread_id, assistant_id, on_delta, run_deadline
+                )
+            # Опрос статуса run сам учитывает срок, остальные пути
+            # ограничиваются снаружи
+            if deadline is not None and (
+                use_chat_completions or on_delta is not None
+            ):
+                request = asyncio.wait_for(request, deadline.remaining())
+            try:
+                response_text, new_thread_id, full_response = await request
+            finally:
+                if deadline is not None and deadline.expired():
+                    deadline.degrade("gpt")
+            metrics.observe(
+                "llm_turn_seconds",
+                loop.time() - started_at,
+                backend=backend,
+                assistant_id=assistant_id,
             )
 
             if (
@@ -132,7 +728,7 @@ async def send_to_gpt(
                 )
 
             if target_language == "kk":
-                response_text = translate_text(
+                response_text = await translate_text(
                     response_text, source_lang="ru", target_lang="kk"
                 )
 
@@ -144,4 +740,8 @@ async def send_to_gpt(
             logger.error(f"Error in send_to_gpt: {e}")
             return "Произошла ошибка при отправке запроса в GPT.", None, None
 
-    return await queue_task(thread_id, task)
+    if not thread_id:
+        # Новый тред создается внутри process_question, гонок за него нет
+        return await task()
+    async with thread_locks.acquire(thread_id):
+        return await task()
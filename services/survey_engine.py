@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import re
+from dataclasses import dataclass
+
+from constants.assistants_answers_var import (
+    DailySurveyQuestions,
+    DAILY_SURVEY_QUESTION_TEXTS,
+)
+from services.openai_service import append_exchange_to_thread
+from utils import metrics, redis_client
+from utils.config import ASSISTANT_ID, LOCAL_SURVEY_ENGINE
+
+logger = logging.getLogger(__name__)
+
+# Поле записи Survey, которое заполняет ответ на каждый вопрос
+SURVEY_FIELDS = {
+    "QUESTION_1": "headache_today",
+    "QUESTION_2": "pain_intensity",
+    "QUESTION_3": "pain_area",
+    "QUESTION_4": "area_detail",
+    "QUESTION_5": "pain_type",
+}
+
+# Шаги, ответ на которые (вариант из списка) обрабатывается локально,
+# и вопрос, который за ними следует. На вопрос 1 после "Да" нужен свой
+# вариант ответа, а после вопроса 5 ассистент задает уточнения в свободной
+# форме и формирует итог, поэтому эти шаги всегда идут через GPT.
+LOCAL_TRANSITIONS = {
+    "QUESTION_2": "QUESTION_3",
+    "QUESTION_3": "QUESTION_4",
+    "QUESTION_4": "QUESTION_5",
+}
+
+
+@dataclass
+class LocalSurveyTurn:
+    """
+    A survey step answered without GPT: the next question to ask.
+    """
+
+    text: str
+    marker: str
+
+
+def normalize_answer(answer):
+    answer = re.sub(r"[^\w\s-]", " ", answer.lower())
+    return re.sub(r"\s+", " ", answer).strip()
+
+
+def match_option(marker, answer):
+    """
+    Возвращает вариант ответа из списка для вопроса marker, если ответ
+    пользователя однозначно с ним совпадает, иначе None.
+    """
+    question = DailySurveyQuestions.__members__.get(marker)
+    if question is None or not answer:
+        return None
+
+    normalized = normalize_answer(answer)
+    for option in question.value["options"]:
+        if normalize_answer(option) == normalized:
+            return option
+    return None
+
+
+def is_local_survey_enabled(assistant_id, user_language):
+    # Тексты вопросов на казахском не передаются в тред ассистента,
+    # поэтому локально обрабатываются только ответы на русском
+    return (
+        LOCAL_SURVEY_ENGINE
+        and assistant_id == ASSISTANT_ID
+        and user_language == "ru"
+    )
+
+
+async def record_question(user_id, assistant_id, marker):
+    if assistant_id == ASSISTANT_ID and marker in SURVEY_FIELDS:
+        await redis_client.set_survey_step(user_id, marker)
+
+
+async def try_answer_locally(user_id, answer, session, user_language):
+    """
+    Проверяет ответ на текущий шаг ежедневного опроса (session - сессия
+    пользователя, уже прочитанная для этого сообщения). Ответ, совпавший
+    с вариантом из списка, сохраняется; если следующий вопрос известен,
+    он возвращается без обращения к GPT, а обмен репликами дописывается
+    в тред ассистента в фоне. Иначе возвращается None.
+    """
+    assistant_id = session.get("assistant_id")
+    thread_id = session.get("thread_id")
+    if not is_local_survey_enabled(assistant_id, user_language):
+        return None
+
+    marker = session.get("survey_step")
+    option = match_option(marker, answer)
+    if option is None:
+        metrics.increment("survey_gpt_turns", reason="free_text")
+        return None
+
+    await redis_client.save_survey_answer(
+        user_id, SURVEY_FIELDS[marker], option
+    )
+
+    next_marker = LOCAL_TRANSITIONS.get(marker)
+    if next_marker is None:
+        metrics.increment("survey_gpt_turns", reason="gpt_step")
+        return None
+
+    next_text = DAILY_SURVEY_QUESTION_TEXTS.get(next_marker)
+    if not next_text:
+        metrics.increment("survey_gpt_turns", reason="unknown_question")
+        return None
+
+    asyncio.create_task(
+        append_exchange_to_thread(
+            thread_id, answer, f"{next_text} [{next_marker}]"
+        )
+    )
+    metrics.increment("survey_local_turns", marker=marker)
+    logger.info(f"Survey step {marker} answered locally for user {user_id}")
+    return LocalSurveyTurn(text=next_text, marker=next_marker)
+
+
+async def merge_local_answers(user_id, response_data):
+    """
+    Заполняет запись Survey ответами, проверенными локально; GPT
+    дополняет только поля со свободным ответом.
+    """
+    answers = await redis_client.get_survey_answers(user_id)
+    for field, value in answers.items():
+        if field == "pain_intensity":
+            value = int(value)
+        response_data[field] = value
+    return response_data
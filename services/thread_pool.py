@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from aioredis.exceptions import RedisError
+
+from services.chat_completions_service import (
+    new_local_thread_id,
+    uses_chat_completions,
+)
+from services.openai_service import get_new_thread_id
+from utils import metrics
+from utils.config import THREAD_POOL_SIZE, THREAD_POOL_REFILL_INTERVAL
+from utils.redis_client import redis
+
+logger = logging.getLogger(__name__)
+
+# Общий для всех воркеров список готовых тредов
+THREAD_POOL_KEY = "openai:thread_pool"
+
+# Блокировка пополнения: пул пополняет только один воркер за раз
+THREAD_POOL_LOCK_KEY = "openai:thread_pool:refill"
+THREAD_POOL_LOCK_TTL = 60
+
+# Запасной пул на время недоступности Redis
+local_thread_pool = deque()
+
+# Сигнал фоновой задаче, что из пула забрали тред
+pool_refill_needed = asyncio.Event()
+
+
+async def acquire_thread_id(assistant_id=None):
+    """
+    Возвращает готовый тред из пула. Если пул пуст, тред создается
+    как раньше, через get_new_thread_id. Ассистентам на Chat Completions
+    тред в OpenAI не нужен: им выдается локальный идентификатор.
+    """
+    if uses_chat_completions(assistant_id):
+        return new_local_thread_id()
+
+    thread_id = None
+    try:
+        thread_id = await redis.lpop(THREAD_POOL_KEY)
+    except RedisError as e:
+        logger.error(f"Failed to take thread from pool: {e}")
+        if local_thread_pool:
+            thread_id = local_thread_pool.popleft()
+
+    if THREAD_POOL_SIZE > 0:
+        pool_refill_needed.set()
+
+    if thread_id:
+        metrics.increment("thread_pool_hits")
+        if isinstance(thread_id, bytes):
+            thread_id = thread_id.decode("utf-8")
+        return thread_id
+
+    metrics.increment("thread_pool_misses")
+    return await get_new_thread_id()
+
+
+async def get_pool_size():
+    try:
+        return await redis.llen(THREAD_POOL_KEY)
+    except RedisError as e:
+        logger.error(f"Failed to read thread pool size: {e}")
+        return len(local_thread_pool)
+
+
+async def refill_thread_pool():
+    try:
+        locked = await redis.set(
+            THREAD_POOL_LOCK_KEY, "1", nx=True, ex=THREAD_POOL_LOCK_TTL
+        )
+    except RedisError as e:
+        logger.error(f"Failed to lock thread pool refill: {e}")
+        locked = True
+    if not locked:
+        return
+
+    try:
+        missing = THREAD_POOL_SIZE - await get_pool_size()
+        if missing <= 0:
+            return
+
+        start_time = time.monotonic()
+        thread_ids = await asyncio.gather(
+            *(get_new_thread_id() for _ in range(missing))
+        )
+        thread_ids = [thread_id for thread_id in thread_ids if thread_id]
+        if not thread_ids:
+            return
+
+        try:
+            await redis.rpush(THREAD_POOL_KEY, *thread_ids)
+        except RedisError as e:
+            logger.error(f"Failed to store threads in pool: {e}")
+            local_thread_pool.extend(thread_ids)
+
+        metrics.observe(
+            "thread_pool_refill_seconds", time.monotonic() - start_time
+        )
+        metrics.increment("thread_pool_created", len(thread_ids))
+        logger.info(f"Thread pool refilled with {len(thread_ids)} threads")
+    finally:
+        metrics.set_gauge("thread_pool_size", await get_pool_size())
+        try:
+            await redis.delete(THREAD_POOL_LOCK_KEY)
+        except RedisError as e:
+            logger.error(f"Failed to unlock thread pool refill: {e}")
+
+
+async def maintain_thread_pool():
+    """
+    Фоновая задача: держит в пуле THREAD_POOL_SIZE тредов. Пополняет
+    пул сразу после выдачи треда и раз в THREAD_POOL_REFILL_INTERVAL
+    секунд, чтобы подхватить треды, выданные другими воркерами.
+    """
+    if THREAD_POOL_SIZE <= 0:
+        return
+
+    while True:
+        try:
+            await refill_thread_pool()
+        except Exception as e:
+            logger.error(f"Failed to refill thread pool: {e}")
+
+        try:
+            await asyncio.wait_for(
+                pool_refill_needed.wait(), THREAD_POOL_REFILL_INTERVAL
+            )
+        except asyncio.TimeoutError:
+            pass
+        pool_refill_needed.clear()
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import os
+import time
+
+from utils import metrics
+from utils.config import FFMPEG_MAX_WORKERS, FFMPEG_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Ограничение на число одновременно запущенных процессов ffmpeg
+transcode_semaphore = asyncio.Semaphore(FFMPEG_MAX_WORKERS)
+
+
+class TranscodingError(Exception):
+    pass
+
+
+def is_mp4_container(data):
+    # MP4/M4A начинается с бокса ftyp; moov может оказаться в конце файла,
+    # поэтому такой вход ffmpeg должен читать из seekable-источника
+    return len(data) > 12 and data[4:8] == b"ftyp"
+
+
+def is_adts(data):
+    # Поток ADTS состоит из самостоятельных кадров, такие фрагменты
+    # можно склеивать побайтно
+    return len(data) > 2 and data[0] == 0xFF and (data[1] & 0xF6) == 0xF0
+
+
+async def run_ffmpeg(data, input_args, output_args):
+    memfd = None
+    if is_mp4_container(data) and hasattr(os, "memfd_create"):
+        # Файл в памяти (memfd) вместо временного файла на диске
+        memfd = os.memfd_create("ffmpeg-input")
+        os.write(memfd, data)
+        os.lseek(memfd, 0, os.SEEK_SET)
+        input_source = f"/proc/self/fd/{memfd}"
+    else:
+        input_source = "pipe:0"
+
+    command = [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        *input_args,
+        "-i",
+        input_source,
+        *output_args,
+        "pipe:1",
+    ]
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=(
+                asyncio.subprocess.DEVNULL
+                if memfd is not None
+                else asyncio.subprocess.PIPE
+            ),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            pass_fds=(memfd,) if memfd is not None else (),
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                process.communicate(None if memfd is not None else data),
+                timeout=FFMPEG_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise TranscodingError(
+                f"ffmpeg timed out after {FFMPEG_TIMEOUT} seconds"
+            )
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+    finally:
+        if memfd is not None:
+            os.close(memfd)
+
+    if process.returncode != 0:
+        raise TranscodingError(
+            f"ffmpeg exited with code {process.returncode}: "
+            f"{stderr.decode('utf-8', errors='replace')[-500:]}"
+        )
+    if not stdout:
+        raise TranscodingError("ffmpeg produced no output")
+    return stdout
+
+
+async def transcode(data, output_args, input_args=(), job="transcode"):
+    """
+    Прогоняет байты через ffmpeg (stdin -> stdout) без записи на диск.
+    Число параллельных процессов ограничено FFMPEG_MAX_WORKERS,
+    время ожидания и выполнения каждой задачи пишется в метрики.
+    """
+    queued_at = time.perf_counter()
+    async with transcode_semaphore:
+        started_at = time.perf_counter()
+        metrics.observe(
+            "ffmpeg_queue_seconds", started_at - queued_at, job=job
+        )
+        try:
+            output = await run_ffmpeg(data, input_args, output_args)
+            metrics.increment("ffmpeg_jobs", job=job, status="success")
+            return output
+        except Exception:
+            metrics.increment("ffmpeg_jobs", job=job, status="error")
+            raise
+        finally:
+            metrics.observe(
+                "ffmpeg_job_seconds", time.perf_counter() - started_at, job=job
+            )
+
+
+async def convert_to_ogg(audio_content):
+    # Тот же кодек, что использовал pydub при экспорте в ogg
+    return await transcode(
+        audio_content, ["-f", "ogg", "-acodec", "libvorbis"], job="to_ogg"
+    )
+
+
+async def convert_mp3_to_aac(audio_content):
+    try:
+        return await transcode(
+            audio_content, ["-c:a", "aac", "-f", "adts"], job="mp3_to_aac"
+        )
+    except TranscodingError as e:
+        logger.warning(f"Failed to transcode to ADTS ({e}), trying mp4")
+        # Фрагментированный mp4 можно писать в pipe без seek
+        return await transcode(
+            audio_content,
+            [
+                "-c:a",
+                "aac",
+                "-f",
+                "mp4",
+                "-movflags",
+                "frag_keyframe+empty_moov",
+            ],
+            job="mp3_to_aac",
+        )
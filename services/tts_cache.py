@@ -0,0 +1,217 @@
+import asyncio
+import hashlib
+import logging
+import re
+
+from aioredis.exceptions import RedisError
+
+from constants.assistants_answers_var import DAILY_SURVEY_QUESTION_TEXTS
+from services.yandex_service import synthesize_speech, VOICE_SETTINGS
+from utils import metrics
+from utils.config import (
+    TTS_CACHE_TTL,
+    TTS_REPLY_CACHE_TTL,
+    TTS_CACHE_MAX_SIZE,
+    TTS_CACHE_MAX_BYTES,
+    TTS_PREWARM_ENABLED,
+    TTS_SEGMENT_CONCURRENCY,
+    TTS_MIN_SEGMENT_LENGTH,
+)
+from utils.redis_client import redis
+from utils.single_flight import SingleFlight
+from utils.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Формат, в котором synthesize_speech отдает аудио
+TTS_AUDIO_FORMAT = "aac"
+
+# Тексты вопросов анкет, по одному на (assistant_id, маркер, язык)
+QUESTION_TEXTS_KEY = "survey_question_texts"
+
+# Локальный уровень кеша; второй уровень - Redis
+tts_local_cache = TTLCache(
+    "tts_audio",
+    TTS_CACHE_MAX_SIZE,
+    TTS_CACHE_TTL,
+    maxbytes=TTS_CACHE_MAX_BYTES,
+)
+
+# Синтезы, которые выполняются прямо сейчас
+pending_syntheses = SingleFlight()
+
+# Тексты вопросов анкет: их аудио хранится в Redis TTS_CACHE_TTL, аудио
+# остальных (уникальных) ответов - только TTS_REPLY_CACHE_TTL
+known_question_texts = TTLCache(
+    "tts_question_texts", TTS_CACHE_MAX_SIZE * 5, TTS_CACHE_TTL
+)
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?…])\s+")
+
+
+def normalize_text(text):
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def tts_cache_key(text, lang_code):
+    settings = VOICE_SETTINGS.get(lang_code, VOICE_SETTINGS["ru"])
+    raw_key = "|".join(
+        [
+            normalize_text(text),
+            settings["voice"],
+            settings["lang"],
+            settings["emotion"],
+            TTS_AUDIO_FORMAT,
+        ]
+    )
+    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+
+async def get_cached_audio(cache_key):
+    audio = tts_local_cache.get(cache_key)
+    if audio is not None:
+        return audio
+    try:
+        audio = await redis.get(f"tts:{cache_key}")
+        if audio:
+            tts_local_cache.set(cache_key, audio)
+            metrics.increment("tts_cache_redis_hits")
+            return audio
+    except RedisError as e:
+        logger.error(f"Failed to read TTS audio from Redis: {e}")
+    return None
+
+
+def is_question_text(text):
+    return normalize_text(text) in known_question_texts
+
+
+def remember_known_question(text):
+    known_question_texts.set(normalize_text(text), True)
+
+
+async def store_audio(cache_key, audio, ttl):
+    tts_local_cache.set(cache_key, audio)
+    try:
+        await redis.set(f"tts:{cache_key}", audio, ex=ttl)
+    except RedisError as e:
+        logger.error(f"Failed to store TTS audio in Redis: {e}")
+
+
+async def synthesize_and_store(text, lang_code, cache_key):
+    audio = await synthesize_speech(text, lang_code)
+    if audio:
+        ttl = TTS_CACHE_TTL if is_question_text(text) else TTS_REPLY_CACHE_TTL
+        await store_audio(cache_key, audio, ttl)
+    return audio
+
+
+async def synthesize_speech_cached(text, lang_code):
+    """
+    synthesize_speech с кешем по (нормализованный текст, голос, язык, формат).
+    Повторяющиеся вопросы анкет отдаются без обращения к Yandex и ffmpeg.
+    """
+    text = normalize_text(text)
+    cache_key = tts_cache_key(text, lang_code)
+
+    audio = await get_cached_audio(cache_key)
+    if audio is not None:
+        metrics.increment("tts_cache_hits")
+        return audio
+    metrics.increment("tts_cache_misses")
+
+    audio, _ = await pending_syntheses.run(
+        cache_key, lambda: synthesize_and_store(text, lang_code, cache_key)
+    )
+    return audio
+
+
+def split_into_sentences(text, min_length=TTS_MIN_SEGMENT_LENGTH):
+    """
+    Делит текст на предложения; слишком короткие предложения
+    объединяются с соседними, чтобы не плодить запросы к TTS.
+    """
+    segments = []
+    for sentence in SENTENCE_BOUNDARY.split(normalize_text(text)):
+        if not sentence:
+            continue
+        if segments and len(segments[-1]) < min_length:
+            segments[-1] = f"{segments[-1]} {sentence}"
+        else:
+            segments.append(sentence)
+
+    if len(segments) > 1 and len(segments[-1]) < min_length:
+        last_segment = segments.pop()
+        segments[-1] = f"{segments[-1]} {last_segment}"
+    return segments
+
+
+def start_segment_synthesis(
+    segments, lang_code, concurrency=TTS_SEGMENT_CONCURRENCY
+):
+    """
+    Запускает синтез фрагментов параллельно, не более concurrency
+    одновременно. Задачи возвращаются в порядке фрагментов.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def synthesize_segment(segment):
+        async with semaphore:
+            return await synthesize_speech_cached(segment, lang_code)
+
+    return [
+        asyncio.ensure_future(synthesize_segment(segment))
+        for segment in segments
+    ]
+
+
+async def remember_question_text(assistant_id, marker, language, text):
+    """
+    Запоминает актуальный текст вопроса анкеты, чтобы синтезировать
+    его заранее при следующем запуске.
+    """
+    if not (assistant_id and marker and text):
+        return
+    remember_known_question(text)
+    try:
+        await redis.hset(
+            QUESTION_TEXTS_KEY,
+            f"{assistant_id}:{marker}:{language}",
+            normalize_text(text),
+        )
+    except RedisError as e:
+        logger.error(f"Failed to remember question text for {marker}: {e}")
+
+
+async def get_question_texts():
+    try:
+        question_texts = await redis.hgetall(QUESTION_TEXTS_KEY)
+    except RedisError as e:
+        logger.error(f"Failed to load question texts: {e}")
+        return {}
+    return {
+        (k.decode("utf-8") if isinstance(k, bytes) else k): (
+            v.decode("utf-8") if isinstance(v, bytes) else v
+        )
+        for k, v in question_texts.items()
+    }
+
+
+async def prewarm_tts_cache(lang_code="ru"):
+    if not TTS_PREWARM_ENABLED:
+        return
+
+    question_texts = set((await get_question_texts()).values())
+    question_texts.update(DAILY_SURVEY_QUESTION_TEXTS.values())
+    for text in question_texts:
+        remember_known_question(text)
+    logger.info(f"Pre-warming TTS cache with {len(question_texts)} texts")
+
+    # Запросы к Yandex ограничены так же, как при синтезе фрагментов
+    results = await asyncio.gather(
+        *start_segment_synthesis(list(question_texts), lang_code),
+        return_exceptions=True,
+    )
+    warmed = sum(1 for result in results if isinstance(result, bytes))
+    metrics.set_gauge("tts_prewarmed_texts", warmed)
+    logger.info(f"TTS cache pre-warmed: {warmed}/{len(results)} texts")
@@ -1,44 +1,115 @@
 import asyncio
-import ffmpeg
-import tempfile
-import requests
+import random
+import httpx
 import logging
-from utils.config import YANDEX_OAUTH_TOKEN, YANDEX_FOLDER_ID
-import subprocess
-import io
+from utils.config import (
+    YANDEX_OAUTH_TOKEN,
+    YANDEX_FOLDER_ID,
+    YANDEX_TIMEOUT,
+    YANDEX_MAX_RETRIES,
+    YANDEX_RETRY_BACKOFF,
+    YANDEX_STT_CONCURRENCY,
+    YANDEX_TTS_CONCURRENCY,
+    YANDEX_TRANSLATE_CONCURRENCY,
+)
+from services.transcoder import convert_mp3_to_aac
+from utils.http_client import get_http_client
 
 YANDEX_IAM_TOKEN = None
 logger = logging.getLogger(__name__)
 
+# Коды ответа, при которых запрос к Yandex повторяется
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
 
-def get_iam_token():
+# Ограничения на число одновременных запросов к каждому API
+stt_semaphore = asyncio.Semaphore(YANDEX_STT_CONCURRENCY)
+tts_semaphore = asyncio.Semaphore(YANDEX_TTS_CONCURRENCY)
+translate_semaphore = asyncio.Semaphore(YANDEX_TRANSLATE_CONCURRENCY)
+iam_token_lock = asyncio.Lock()
+
+VOICE_SETTINGS = {
+    "ru": {"lang": "ru-RU", "voice": "jane", "emotion": "good"},
+    "kk": {"lang": "kk-KK", "voice": "amira", "emotion": "neutral"},
+}
+
+
+async def get_iam_token():
     global YANDEX_IAM_TOKEN
-    url = "https://iam.api.cloud.yandex.net/iam/v1/tokens"
-    payload = {"yandexPassportOauthToken": YANDEX_OAUTH_TOKEN}
-    response = requests.post(url, json=payload)
-    response.raise_for_status()
-    YANDEX_IAM_TOKEN = response.json()["iamToken"]
-    logger.info(f"Received new IAM token: {YANDEX_IAM_TOKEN}")
+    async with iam_token_lock:
+        url = "https://iam.api.cloud.yandex.net/iam/v1/tokens"
+        payload = {"yandexPassportOauthToken": YANDEX_OAUTH_TOKEN}
+        response = await get_http_client().post(
+            url, json=payload, timeout=YANDEX_TIMEOUT
+        )
+        response.raise_for_status()
+        YANDEX_IAM_TOKEN = response.json()["iamToken"]
+        logger.info("Received new IAM token")
 
 
 async def refresh_iam_token():
     while True:
         await asyncio.sleep(6 * 3600)
-        get_iam_token()
-        logger.info("IAM token refreshed")
+        try:
+            await get_iam_token()
+            logger.info("IAM token refreshed")
+        except Exception as e:
+            logger.error(f"Failed to refresh IAM token: {e}")
+
+
+async def yandex_request(url, semaphore, headers=None, **kwargs):
+    """
+    POST-запрос к API Yandex через общий пул соединений.
+    Повторяет запрос с экспоненциальной задержкой при сетевых ошибках,
+    429 и 5xx, а при 401 один раз обновляет IAM-токен.
+    """
+    if not YANDEX_IAM_TOKEN:
+        await get_iam_token()
+
+    client = get_http_client()
+    token_refreshed = False
+    attempt = 0
+    while True:
+        request_headers = {"Authorization": f"Bearer {YANDEX_IAM_TOKEN}"}
+        request_headers.update(headers or {})
+        try:
+            async with semaphore:
+                response = await client.post(
+                    url,
+                    headers=request_headers,
+                    timeout=YANDEX_TIMEOUT,
+                    **kwargs,
+                )
+            if response.status_code == 401 and not token_refreshed:
+                logger.warning("Yandex API returned 401, refreshing IAM token")
+                token_refreshed = True
+                await get_iam_token()
+                continue
+            if (
+                response.status_code not in RETRY_STATUS_CODES
+                or attempt >= YANDEX_MAX_RETRIES
+            ):
+                return response
+            logger.warning(
+                f"Yandex API returned {response.status_code}, retrying"
+            )
+        except httpx.TransportError as e:
+            if attempt >= YANDEX_MAX_RETRIES:
+                raise
+            logger.warning(f"Yandex API request failed: {e}, retrying")
+
+        delay = YANDEX_RETRY_BACKOFF * (2**attempt)
+        await asyncio.sleep(delay + random.uniform(0, delay))
+        attempt += 1
 
 
-def recognize_speech(audio_content, lang="ru-RU"):
+async def recognize_speech(audio_content, lang="ru-RU"):
     try:
-        if not YANDEX_IAM_TOKEN:
-            get_iam_token()
         url = f"https://stt.api.cloud.yandex.net/speech/v1/stt:recognize?folderId={YANDEX_FOLDER_ID}&lang={lang}"
-        headers = {"Authorization": f"Bearer {YANDEX_IAM_TOKEN}"}
 
-        logger.info(
-            f"Sending request to Yandex STT API with URL: {url} and headers: {headers}"
+        logger.info(f"Sending request to Yandex STT API with URL: {url}")
+        response = await yandex_request(
+            url, stt_semaphore, content=audio_content
         )
-        response = requests.post(url, headers=headers, data=audio_content)
 
         if response.status_code == 200:
             result = response.json().get("result")
@@ -58,29 +129,13 @@ def recognize_speech(audio_content, lang="ru-RU"):
         return None
 
 
-def convert_mp3_to_aac(input_mp3, output_aac):
-    try:
-        subprocess.run(
-            ["ffmpeg", "-y", "-i", input_mp3, "-c:a", "aac", output_aac],
-            check=True,
-        )
-        print(f"Conversion successful: {output_aac}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error: {e.stderr.decode('utf8')}")
-
-
-def synthesize_speech(text, lang_code):
+async def synthesize_speech(text, lang_code):
     try:
         logger.info(
             f"Starting synthesis for text: '{text[:100]}' with lang_code: '{lang_code}'"
         )
-        voice_settings = {
-            "ru": {"lang": "ru-RU", "voice": "jane", "emotion": "good"},
-            "kk": {"lang": "kk-KK", "voice": "amira", "emotion": "neutral"},
-        }
-        settings = voice_settings.get(lang_code, voice_settings["ru"])
+        settings = VOICE_SETTINGS.get(lang_code, VOICE_SETTINGS["ru"])
         url = "https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize"
-        headers = {"Authorization": f"Bearer {YANDEX_IAM_TOKEN}"}
 
         data = {
             "text": text,
@@ -92,55 +147,10 @@ def synthesize_speech(text, lang_code):
             "sampleRateHertz": 48000,
             "speed": "1.2",
         }
-        response = requests.post(url, headers=headers, data=data, stream=True)
+        response = await yandex_request(url, tts_semaphore, data=data)
         if response.status_code == 200:
             logger.info(f"Audio response content: OK for text: '{text[:100]}'")
-
-            input_audio = io.BytesIO(response.content)
-            temp_input = tempfile.NamedTemporaryFile(
-                delete=False, suffix=".mp3"
-            )
-            temp_output = tempfile.NamedTemporaryFile(
-                delete=False, suffix=".aac"
-            )
-
-            with open(temp_input.name, "wb") as f:
-                f.write(input_audio.read())
-
-            # Попробуем сначала считать файл как MP3
-            try:
-                subprocess.run(
-                    [
-                        "ffmpeg",
-                        "-y",
-                        "-i",
-                        temp_input.name,
-                        "-c:a",
-                        "aac",
-                        temp_output.name,
-                    ],
-                    check=True,
-                )
-            except subprocess.CalledProcessError:
-                logger.warning(f"Failed to decode as mp3, trying as mp4")
-                # Если не удалось, пробуем считать файл как MP4
-                subprocess.run(
-                    [
-                        "ffmpeg",
-                        "-y",
-                        "-i",
-                        temp_input.name,
-                        "-f",
-                        "mp4",
-                        "-c:a",
-                        "aac",
-                        temp_output.name,
-                    ],
-                    check=True,
-                )
-
-            with open(temp_output.name, "rb") as f:
-                return f.read()
+            return await convert_mp3_to_aac(response.content)
 
         else:
             error_message = f"Failed to synthesize speech, status code: {response.status_code}, response text: {response.text[:200]}"
@@ -151,12 +161,24 @@ def synthesize_speech(text, lang_code):
         return None
 
 
-def translate_text(text, source_lang="ru", target_lang="kk"):
+# Тексты, которые translate_text возвращает вместо перевода при ошибке
+TRANSLATION_NOT_FOUND = "Перевод не найден."
+TRANSLATION_REQUEST_ERROR = "Ошибка при запросе перевода."
+TRANSLATION_UNEXPECTED_ERROR = "Произошла неожиданная ошибка."
+TRANSLATION_ERRORS = (
+    TRANSLATION_NOT_FOUND,
+    TRANSLATION_REQUEST_ERROR,
+    TRANSLATION_UNEXPECTED_ERROR,
+)
+
+
+def is_translation_error(text):
+    return text in TRANSLATION_ERRORS
+
+
+async def translate_text(text, source_lang="ru", target_lang="kk"):
     url = "https://translate.api.cloud.yandex.net/translate/v2/translate"
-    headers = {
-        "Authorization": f"Bearer {YANDEX_IAM_TOKEN}",
-        "Content-Type": "application/json",
-    }
+    headers = {"Content-Type": "application/json"}
     payload = {
         "folder_id": YANDEX_FOLDER_ID,
         "texts": [text],
@@ -165,17 +187,19 @@ def translate_text(text, source_lang="ru", target_lang="kk"):
     }
 
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        response = await yandex_request(
+            url, translate_semaphore, headers=headers, json=payload
+        )
         response.raise_for_status()
         translations = response.json().get("translations", [])
         if translations:
             return translations[0]["text"]
         else:
             logger.error("Translation not found in response")
-            return "Перевод не найден."
-    except requests.exceptions.RequestException as e:
+            return TRANSLATION_NOT_FOUND
+    except httpx.HTTPError as e:
         logger.error(f"Error during translation request: {e}")
-        return "Ошибка при запросе перевода."
+        return TRANSLATION_REQUEST_ERROR
     except Exception as e:
         logger.error(f"Unexpected error during translation: {e}")
-        return "Произошла неожиданная ошибка."
+        return TRANSLATION_UNEXPECTED_ERROR
@@ -17,3 +17,194 @@ REDIS_URL = os.getenv("REDIS_URL", default="")
 
 YANDEX_OAUTH_TOKEN = os.getenv("YANDEX_OAUTH_TOKEN")
 YANDEX_FOLDER_ID = os.getenv("YANDEX_FOLDER_ID")
+
+AUTH_SERVER_URL = os.getenv(
+    "AUTH_SERVER_URL", default="https://backoffice.daribar.com/api/v1/users"
+)
+# Интервал (в секундах) повторной проверки токена внутри одного соединения
+AUTH_REVERIFY_INTERVAL = int(
+    os.getenv("AUTH_REVERIFY_INTERVAL", default="900")
+)
+
+# Кеширование результатов проверки токенов
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", default="300"))
+AUTH_NEGATIVE_CACHE_TTL = int(
+    os.getenv("AUTH_NEGATIVE_CACHE_TTL", default="30")
+)
+AUTH_CACHE_MAX_SIZE = int(os.getenv("AUTH_CACHE_MAX_SIZE", default="10000"))
+AUTH_CACHE_USE_REDIS = (
+    os.getenv("AUTH_CACHE_USE_REDIS", default="false").lower() == "true"
+)
+
+# Общий HTTP-клиент
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", default="30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", default="5"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", default="100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", default="20")
+)
+
+# Клиент Yandex SpeechKit / Translate
+YANDEX_TIMEOUT = float(os.getenv("YANDEX_TIMEOUT", default="30"))
+YANDEX_MAX_RETRIES = int(os.getenv("YANDEX_MAX_RETRIES", default="2"))
+YANDEX_RETRY_BACKOFF = float(os.getenv("YANDEX_RETRY_BACKOFF", default="0.3"))
+YANDEX_STT_CONCURRENCY = int(os.getenv("YANDEX_STT_CONCURRENCY", default="10"))
+YANDEX_TTS_CONCURRENCY = int(os.getenv("YANDEX_TTS_CONCURRENCY", default="10"))
+YANDEX_TRANSLATE_CONCURRENCY = int(
+    os.getenv("YANDEX_TRANSLATE_CONCURRENCY", default="20")
+)
+
+# Пул процессов ffmpeg
+FFMPEG_MAX_WORKERS = int(os.getenv("FFMPEG_MAX_WORKERS", default="4"))
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT", default="30"))
+
+# Кеш результатов распознавания речи
+STT_CACHE_TTL = int(os.getenv("STT_CACHE_TTL", default="3600"))
+STT_CACHE_MAX_SIZE = int(os.getenv("STT_CACHE_MAX_SIZE", default="1000"))
+
+# Кеш синтезированной речи
+TTS_CACHE_TTL = int(os.getenv("TTS_CACHE_TTL", default=str(7 * 24 * 3600)))
+TTS_CACHE_MAX_SIZE = int(os.getenv("TTS_CACHE_MAX_SIZE", default="200"))
+# Аудио ответов, не являющихся вопросами анкет, хранится в Redis недолго
+TTS_REPLY_CACHE_TTL = int(os.getenv("TTS_REPLY_CACHE_TTL", default="600"))
+TTS_CACHE_MAX_BYTES = int(
+    os.getenv("TTS_CACHE_MAX_BYTES", default=str(32 * 1024 * 1024))
+)
+TTS_PREWARM_ENABLED = (
+    os.getenv("TTS_PREWARM_ENABLED", default="true").lower() == "true"
+)
+
+# Прогрессивная доставка: текст ответа сразу, аудио отдельным сообщением
+PROGRESSIVE_AUDIO_DELIVERY = (
+    os.getenv("PROGRESSIVE_AUDIO_DELIVERY", default="false").lower() == "true"
+)
+AUDIO_DELIVERY_TIMEOUT = float(
+    os.getenv("AUDIO_DELIVERY_TIMEOUT", default="60")
+)
+
+# Синтез длинных ответов по предложениям с потоковой отправкой фрагментов
+TTS_SENTENCE_STREAMING = (
+    os.getenv("TTS_SENTENCE_STREAMING", default="false").lower() == "true"
+)
+TTS_SEGMENT_CONCURRENCY = int(
+    os.getenv("TTS_SEGMENT_CONCURRENCY", default="3")
+)
+TTS_MIN_SEGMENT_LENGTH = int(os.getenv("TTS_MIN_SEGMENT_LENGTH", default="40"))
+
+# Потоковая отправка ответа ассистента (message_delta)
+OPENAI_STREAMING = (
+    os.getenv("OPENAI_STREAMING", default="false").lower() == "true"
+)
+
+# Адаптивный опрос статуса run
+RUN_POLL_INITIAL_INTERVAL = float(
+    os.getenv("RUN_POLL_INITIAL_INTERVAL", default="0.05")
+)
+RUN_POLL_MAX_INTERVAL = float(
+    os.getenv("RUN_POLL_MAX_INTERVAL", default="1.5")
+)
+RUN_POLL_BACKOFF = float(os.getenv("RUN_POLL_BACKOFF", default="1.6"))
+RUN_POLL_JITTER = float(os.getenv("RUN_POLL_JITTER", default="0.2"))
+OPENAI_RUN_TIMEOUT = float(os.getenv("OPENAI_RUN_TIMEOUT", default="60"))
+
+# Сколько последних сообщений run запрашивать у OpenAI
+OPENAI_RUN_MESSAGES_LIMIT = int(
+    os.getenv("OPENAI_RUN_MESSAGES_LIMIT", default="10")
+)
+
+# Локальная обработка шагов ежедневного опроса с фиксированными вариантами
+LOCAL_SURVEY_ENGINE = (
+    os.getenv("LOCAL_SURVEY_ENGINE", default="false").lower() == "true"
+)
+
+# Пул заранее созданных тредов OpenAI; 0 отключает пул
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", default="10"))
+THREAD_POOL_REFILL_INTERVAL = float(
+    os.getenv("THREAD_POOL_REFILL_INTERVAL", default="30")
+)
+
+# Кеш первого ответа ассистента в новой сессии
+GREETING_CACHE_ENABLED = (
+    os.getenv("GREETING_CACHE_ENABLED", default="true").lower() == "true"
+)
+GREETING_CACHE_TTL = int(os.getenv("GREETING_CACHE_TTL", default="86400"))
+ASSISTANT_VERSION_TTL = int(os.getenv("ASSISTANT_VERSION_TTL", default="300"))
+
+# Ассистенты (через запятую), которые работают через Chat Completions
+# с историей диалога в Redis вместо Assistants API
+CHAT_COMPLETIONS_ASSISTANTS = [
+    assistant_id.strip()
+    for assistant_id in os.getenv(
+        "CHAT_COMPLETIONS_ASSISTANTS", default=""
+    ).split(",")
+    if assistant_id.strip()
+]
+# Модель для Chat Completions; по умолчанию берется модель ассистента
+CHAT_COMPLETIONS_MODEL = os.getenv("CHAT_COMPLETIONS_MODEL", default="")
+CHAT_SUMMARY_MODEL = os.getenv("CHAT_SUMMARY_MODEL", default="gpt-4o-mini")
+CHAT_HISTORY_MAX_MESSAGES = int(
+    os.getenv("CHAT_HISTORY_MAX_MESSAGES", default="30")
+)
+CHAT_HISTORY_KEEP_MESSAGES = int(
+    os.getenv("CHAT_HISTORY_KEEP_MESSAGES", default="10")
+)
+CHAT_HISTORY_TTL = int(os.getenv("CHAT_HISTORY_TTL", default="86400"))
+
+# Маркер вопроса и итоговые данные анкеты передаются ассистентом через
+# вызовы функций, а не в тексте ответа
+ASSISTANT_STRUCTURED_OUTPUT = (
+    os.getenv("ASSISTANT_STRUCTURED_OUTPUT", default="false").lower() == "true"
+)
+
+# Отмена незавершенного хода (run GPT, синтез, запись в базу), когда
+# клиент отключился или прислал новое сообщение
+CANCEL_TURNS_ON_DISCONNECT = (
+    os.getenv("CANCEL_TURNS_ON_DISCONNECT", default="true").lower() == "true"
+)
+CANCEL_SUPERSEDED_TURNS = (
+    os.getenv("CANCEL_SUPERSEDED_TURNS", default="true").lower() == "true"
+)
+RUN_CANCEL_TIMEOUT = float(os.getenv("RUN_CANCEL_TIMEOUT", default="5"))
+
+# Сообщения пользователя, пришедшие с интервалом меньше окна (секунды),
+# объединяются в один запрос к GPT. По умолчанию окна нет: объединяются
+# только сообщения, пришедшие, пока предыдущий ход еще выполнялся
+MESSAGE_COALESCE_WINDOW = float(
+    os.getenv("MESSAGE_COALESCE_WINDOW", default="0")
+)
+CONVERSATION_ACTOR_IDLE_TIMEOUT = float(
+    os.getenv("CONVERSATION_ACTOR_IDLE_TIMEOUT", default="60")
+)
+
+# Бюджет времени на один ход (секунды): этапы, которые в него не
+# укладываются, деградируют (ответ без аудио, без перевода)
+TURN_DEADLINE = float(os.getenv("TURN_DEADLINE", default="25"))
+# Минимальный остаток бюджета, при котором ответ еще переводится
+TRANSLATION_MIN_BUDGET = float(
+    os.getenv("TRANSLATION_MIN_BUDGET", default="1.5")
+)
+
+# Время жизни сессии пользователя в Redis (секунды)
+SESSION_TTL = int(os.getenv("SESSION_TTL", default="604800"))
+
+# Локальный кеш на время недоступности Redis
+LOCAL_CACHE_MAX_USERS = int(os.getenv("LOCAL_CACHE_MAX_USERS", default="5000"))
+LOCAL_CACHE_MAX_BYTES = int(
+    os.getenv("LOCAL_CACHE_MAX_BYTES", default=str(16 * 1024 * 1024))
+)
+LOCAL_CACHE_TTL = int(os.getenv("LOCAL_CACHE_TTL", default="86400"))
+
+# Идемпотентность сообщений клиента по front_id (секунды)
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", default="86400"))
+IDEMPOTENCY_PENDING_TTL = int(
+    os.getenv("IDEMPOTENCY_PENDING_TTL", default="120")
+)
+
+# Кеш сессий в памяти процесса с инвалидацией через CLIENT TRACKING
+REDIS_NEAR_CACHE = (
+    os.getenv("REDIS_NEAR_CACHE", default="false").lower() == "true"
+)
+REDIS_NEAR_CACHE_SIZE = int(
+    os.getenv("REDIS_NEAR_CACHE_SIZE", default="10000")
+)
+REDIS_NEAR_CACHE_TTL = int(os.getenv("REDIS_NEAR_CACHE_TTL", default="300"))
@@ -0,0 +1,48 @@
+import asyncio
+import logging
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Deadline:
+    """
+    Time budget of one turn, measured on the event loop clock.
+
+    Created when the work actually starts (accepting a message, answering
+    a turn), so time spent waiting in the conversation queue is not
+    charged to it, and passed through every stage; a stage that does not
+    fit into the remaining budget is degraded instead of holding the
+    connection, and every degradation is counted in
+    turn_degradations{stage}.
+    """
+
+    def __init__(self, budget):
+        self.expires_at = asyncio.get_running_loop().time() + budget
+
+    def remaining(self):
+        return max(self.expires_at - asyncio.get_running_loop().time(), 0)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def allows(self, seconds):
+        return self.remaining() >= seconds
+
+    def degrade(self, stage):
+        metrics.increment("turn_degradations", stage=stage)
+        logger.warning(
+            f"Turn budget exhausted at stage {stage}, degrading response"
+        )
+
+    async def run(self, awaitable, stage, default=None):
+        """
+        Выполняет этап в пределах оставшегося бюджета. Если этап не
+        успел, он отменяется и возвращается default.
+        """
+        try:
+            return await asyncio.wait_for(awaitable, self.remaining())
+        except asyncio.TimeoutError:
+            self.degrade(stage)
+            return default
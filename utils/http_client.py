@@ -0,0 +1,38 @@
+import logging
+
+import httpx
+
+from utils.config import (
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Общий для процесса HTTP-клиент с пулом keep-alive соединений
+_client = None
+
+
+def get_http_client():
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+        )
+        logger.info("Created shared HTTP client")
+    return _client
+
+
+async def close_http_client():
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+        logger.info("Closed shared HTTP client")
+    _client = None
@@ -0,0 +1,82 @@
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Границы бакетов гистограмм по умолчанию (секунды)
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Простые счетчики, gauge-значения и гистограммы в памяти процесса
+counters = defaultdict(float)
+gauges = {}
+histograms = {}
+
+
+def _metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    counters[_metric_key(name, labels)] += value
+
+
+def set_gauge(name, value, **labels):
+    gauges[_metric_key(name, labels)] = value
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    key = _metric_key(name, labels)
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = {
+            "count": 0,
+            "sum": 0.0,
+            "min": None,
+            "max": None,
+            "buckets": {bound: 0 for bound in buckets},
+        }
+        histograms[key] = histogram
+
+    histogram["count"] += 1
+    histogram["sum"] += value
+    if histogram["min"] is None or value < histogram["min"]:
+        histogram["min"] = value
+    if histogram["max"] is None or value > histogram["max"]:
+        histogram["max"] = value
+    for bound in histogram["buckets"]:
+        if value <= bound:
+            histogram["buckets"][bound] += 1
+
+
+def get_counter(name, **labels):
+    return counters.get(_metric_key(name, labels), 0)
+
+
+def _format_key(key):
+    name, labels = key
+    if not labels:
+        return name
+    label_str = ",".join(f"{k}={v}" for k, v in labels)
+    return f"{name}{{{label_str}}}"
+
+
+def snapshot():
+    """
+    Возвращает текущее состояние всех метрик в виде словаря,
+    пригодного для сериализации в JSON.
+    """
+    return {
+        "counters": {_format_key(k): v for k, v in counters.items()},
+        "gauges": {_format_key(k): v for k, v in gauges.items()},
+        "histograms": {
+            _format_key(k): {
+                "count": h["count"],
+                "sum": h["sum"],
+                "avg": h["sum"] / h["count"] if h["count"] else 0,
+                "min": h["min"],
+                "max": h["max"],
+                "buckets": {str(b): c for b, c in h["buckets"].items()},
+            }
+            for k, h in histograms.items()
+        },
+    }
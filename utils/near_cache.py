@@ -0,0 +1,170 @@
+import asyncio
+import logging
+
+from aioredis.exceptions import RedisError
+
+from utils import metrics
+from utils.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Канал, в который Redis публикует инвалидации отслеживаемых ключей
+INVALIDATE_CHANNEL = "__redis__:invalidate"
+
+# Пауза перед переподключением после обрыва соединения инвалидаций
+RECONNECT_DELAY = 1
+
+# Интервал и таймаут проверки соединения, на котором включен трекинг
+TRACKER_PING_INTERVAL = 5
+TRACKER_PING_TIMEOUT = 2
+
+
+class NearCache:
+    """
+    Process-local copy of Redis keys under a prefix, kept coherent by
+    server-assisted client-side caching.
+
+    A dedicated connection subscribes to __redis__:invalidate and another
+    one enables CLIENT TRACKING in BCAST mode for the prefix, redirected
+    to the subscriber, so a change of any matching key by any worker
+    drops the local copy. Entries are served only while both connections
+    are up; when either drops, the cache is flushed and tracking is
+    enabled again on fresh connections. Every invalidation bumps a generation counter; a value read
+    from Redis is stored only if no invalidation happened since the read
+    started, so a late reply can not resurrect stale data.
+    """
+
+    def __init__(self, name, prefix, maxsize, ttl):
+        self.name = name
+        self.prefix = prefix
+        self.cache = TTLCache(name, maxsize, ttl)
+        self.generation = 0
+        self.connected = False
+
+    def get(self, key):
+        if not self.connected:
+            return None
+        return self.cache.get(key)
+
+    def set(self, key, value, generation):
+        if self.connected and generation == self.generation:
+            self.cache.set(key, value)
+
+    def invalidate(self, key=None):
+        self.generation += 1
+        if key is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(key)
+
+    def stats(self):
+        hits = metrics.get_counter("cache_hits", cache=self.name)
+        misses = metrics.get_counter("cache_misses", cache=self.name)
+        return {
+            **self.cache.stats(),
+            "connected": self.connected,
+            "generation": self.generation,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else None,
+            "invalidations": metrics.get_counter(
+                "near_cache_invalidations", cache=self.name
+            ),
+        }
+
+    async def listen(self, redis):
+        pool = redis.connection_pool
+        listener = await pool.get_connection("SUBSCRIBE")
+        tracker = await pool.get_connection("CLIENT")
+        try:
+            await listener.send_command("CLIENT", "ID")
+            client_id = await listener.read_response()
+            await listener.send_command("SUBSCRIBE", INVALIDATE_CHANNEL)
+            await listener.read_response()
+
+            await tracker.send_command(
+                "CLIENT",
+                "TRACKING",
+                "ON",
+                "REDIRECT",
+                client_id,
+                "BCAST",
+                "PREFIX",
+                self.prefix,
+            )
+            await tracker.read_response()
+
+            # Изменения, пропущенные до подписки, не должны остаться в кеше
+            self.invalidate()
+            self.connected = True
+            logger.info(f"Near cache {self.name} tracking '{self.prefix}*'")
+
+            # Трекинг живет, пока живо соединение, которое его включило:
+            # обрыв любого из двух соединений завершает listen
+            tasks = [
+                asyncio.create_task(self.receive_invalidations(listener)),
+                asyncio.create_task(self.watch_tracker(tracker)),
+            ]
+            try:
+                done, _ = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    task.result()
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            self.connected = False
+            self.invalidate()
+            # Отслеживание привязано к соединению: соединения закрываются,
+            # чтобы в пул не вернулось соединение с включенным трекингом
+            for connection in (listener, tracker):
+                await connection.disconnect()
+                await pool.release(connection)
+
+    async def receive_invalidations(self, listener):
+        while True:
+            message = await listener.read_response()
+            if message[0] != b"message":
+                continue
+            keys = message[2]
+            if keys is None:
+                # FLUSHDB/FLUSHALL
+                self.invalidate()
+                metrics.increment("near_cache_invalidations", cache=self.name)
+                continue
+            for key in keys:
+                self.invalidate(
+                    key.decode("utf-8") if isinstance(key, bytes) else key
+                )
+            metrics.increment(
+                "near_cache_invalidations", len(keys), cache=self.name
+            )
+
+    async def watch_tracker(self, tracker):
+        """
+        Соединение с трекингом ничего не читает, поэтому его обрыв
+        обнаруживается периодическим PING.
+        """
+        while True:
+            await asyncio.sleep(TRACKER_PING_INTERVAL)
+            await tracker.send_command("PING")
+            await asyncio.wait_for(
+                tracker.read_response(), TRACKER_PING_TIMEOUT
+            )
+
+    async def run(self, redis):
+        """
+        Фоновая задача: держит соединение инвалидаций и переподключается
+        после обрыва. Пока соединения нет, чтения идут в Redis.
+        """
+        while True:
+            try:
+                await self.listen(redis)
+            except (RedisError, OSError, asyncio.TimeoutError) as e:
+                logger.error(f"Near cache {self.name} disconnected: {e}")
+            except Exception as e:
+                logger.error(f"Near cache {self.name} failed: {e}")
+            await asyncio.sleep(RECONNECT_DELAY)
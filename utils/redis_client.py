@@ -1,300 +1,399 @@
 import aioredis
 import logging
-from utils.config import REDIS_URL
+import sys
+from utils.config import (
+    REDIS_URL,
+    SESSION_TTL,
+    LOCAL_CACHE_MAX_USERS,
+    LOCAL_CACHE_MAX_BYTES,
+    LOCAL_CACHE_TTL,
+    REDIS_NEAR_CACHE_SIZE,
+    REDIS_NEAR_CACHE_TTL,
+)
 from aioredis.exceptions import RedisError
-from collections import defaultdict
+from utils.near_cache import NearCache
+from utils.ttl_cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
 # Инициализация подключения к Redis
 redis = aioredis.from_url(REDIS_URL)
 
-# Локальный кеш для хранения данных при отказе Redis
-local_thread_cache = defaultdict(dict)
+
+def estimate_size(value):
+    """
+    Приблизительный размер записи локального кеша в байтах, включая
+    вложенные строки, словари и множества.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(
+            estimate_size(k) + estimate_size(v) for k, v in value.items()
+        )
+    elif isinstance(value, (set, frozenset, list, tuple)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+
+# Локальный кеш для хранения данных при отказе Redis: ограничен числом
+# пользователей, объемом и временем жизни записи
+local_thread_cache = TTLCache(
+    "redis_fallback",
+    LOCAL_CACHE_MAX_USERS,
+    LOCAL_CACHE_TTL,
+    maxbytes=LOCAL_CACHE_MAX_BYTES,
+    sizeof=estimate_size,
+)
+
+
+def local_cache_stats():
+    return local_thread_cache.stats()
 
 
-# Логирование всего кеша
-def log_local_cache():
-    logger.info(
-        f"Current state of local_thread_cache: {dict(local_thread_cache)}"
-    )
+def get_local_entry(user_id):
+    return dict(local_thread_cache.get(user_id) or {})
+
+
+# Чтение перед обновлением записи - не обращение к кешу: попадания и
+# промахи учитываются только для чтений при отказе Redis
+def peek_local_entry(user_id):
+    return dict(local_thread_cache.peek(user_id) or {})
+
+
+# Запись пересохраняется целиком, чтобы пересчитать ее размер и срок жизни
+def store_local_entry(user_id, entry):
+    if entry:
+        local_thread_cache.set(user_id, entry)
+    else:
+        local_thread_cache.pop(user_id)
 
 
 # Очистка локального кеша для конкретного пользователя
 def clear_local_cache(user_id):
-    if user_id in local_thread_cache:
-        del local_thread_cache[user_id]
+    if local_thread_cache.pop(user_id) is not None:
         logger.info(f"Cleared local cache for user {user_id}")
-    else:
-        logger.info(f"No local cache found for user {user_id}")
 
 
-# Функция для синхронизации данных из Redis в локальный кеш при первом сбое Redis
-async def sync_redis_to_cache(user_id):
-    try:
-        # Попытка получить данные из Redis
-        state = await redis.get(f"user_state:{user_id}")
-        thread_id = await redis.get(f"thread_id:{user_id}")
-        assistant_id = await redis.get(f"assistant_id:{user_id}")
-        processed_messages = await redis.smembers(f"processed:{user_id}")
-
-        # Если данные из Redis получены, сохраняем их в локальный кеш
-        if state:
-            local_thread_cache[user_id]["state"] = (
-                state.decode("utf-8") if isinstance(state, bytes) else state
-            )
-        if thread_id:
-            local_thread_cache[user_id]["thread_id"] = (
-                thread_id.decode("utf-8")
-                if isinstance(thread_id, bytes)
-                else thread_id
-            )
-        if assistant_id:
-            local_thread_cache[user_id]["assistant_id"] = (
-                assistant_id.decode("utf-8")
-                if isinstance(assistant_id, bytes)
-                else assistant_id
-            )
-        if processed_messages:
-            local_thread_cache[user_id]["processed_messages"] = set(
-                processed_messages
-            )
+# Поля сессии пользователя, хранящиеся в одном хеше session:{user_id}
+SESSION_FIELDS = ("state", "thread_id", "assistant_id", "survey_step")
 
-        logger.info(
-            f"Data synchronized from Redis to cache for user {user_id}"
-        )
-        log_local_cache()
+# Ключи, в которых сессия хранилась до перехода на хеш
+LEGACY_SESSION_KEYS = {
+    "state": "user_state:{user_id}",
+    "thread_id": "thread_id:{user_id}",
+    "assistant_id": "assistant_id:{user_id}",
+}
 
-    except RedisError as e:
-        logger.error(
-            f"Failed to synchronize Redis to cache for user {user_id}: {e}"
-        )
 
+# Сессии, которые читаются из памяти процесса, пока Redis не сообщит
+# об их изменении (включается через REDIS_NEAR_CACHE, см. main.py)
+session_near_cache = NearCache(
+    "session_near_cache",
+    "session:",
+    REDIS_NEAR_CACHE_SIZE,
+    REDIS_NEAR_CACHE_TTL,
+)
 
-# Обертка для операций с Redis, синхронизация данных при успешных операциях
-async def redis_operation_with_sync(func, *args, user_id=None, **kwargs):
-    try:
-        # Выполнение операции с Redis
-        result = await func(*args, **kwargs)
 
-        # Синхронизация данных в локальный кэш после успешной операции
-        if user_id:
-            await sync_redis_to_cache(user_id)
-        return result
-    except RedisError as e:
-        logger.error(f"Redis Error during operation: {e}")
-        if user_id:
-            await sync_redis_to_cache(user_id)
-        return None
+def near_cache_stats():
+    return session_near_cache.stats()
 
 
-# Функция для работы с состоянием пользователя
-async def get_user_state(user_id):
-    try:
-        result = await redis_operation_with_sync(
-            redis.get, f"user_state:{user_id}", user_id=user_id
+def session_key(user_id):
+    return f"session:{user_id}"
+
+
+def decode_session(raw_session):
+    return {
+        (k.decode("utf-8") if isinstance(k, bytes) else k): (
+            v.decode("utf-8") if isinstance(v, bytes) else v
         )
-        if result:
-            return result
-        # Если в Redis нет данных, берем их из локального кэша
-        return local_thread_cache.get(user_id, {}).get("state")
-    except RedisError as e:
-        logger.error(f"Redis Error in get_user_state for user {user_id}: {e}")
-        return local_thread_cache.get(user_id, {}).get("state")
+        for k, v in raw_session.items()
+    }
 
 
-async def set_user_state(user_id, state):
+# Локальный кеш обновляется из того же ответа Redis, без отдельных запросов
+def refresh_local_session(user_id, session):
+    cached = peek_local_entry(user_id)
+    for field in SESSION_FIELDS:
+        if field in session:
+            cached[field] = session[field]
+        else:
+            cached.pop(field, None)
+    store_local_entry(user_id, cached)
+
+
+def get_local_session(user_id):
+    cached = get_local_entry(user_id)
+    return {
+        field: cached[field] for field in SESSION_FIELDS if field in cached
+    }
+
+
+def legacy_session_keys(user_id):
+    return {
+        field: key.format(user_id=user_id)
+        for field, key in LEGACY_SESSION_KEYS.items()
+    }
+
+
+async def migrate_legacy_session(user_id, values):
+    """
+    Переносит сессию из отдельных ключей user_state/thread_id/assistant_id
+    в хеш. Вызывается только когда хеш пуст.
+    """
+    legacy_keys = legacy_session_keys(user_id)
+    session = {
+        field: value
+        for field, value in zip(legacy_keys, values)
+        if value is not None
+    }
+    if not session:
+        return {}
+
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(session_key(user_id), mapping=session)
+        pipe.expire(session_key(user_id), SESSION_TTL)
+        pipe.delete(*legacy_keys.values())
+        await pipe.execute()
+    logger.info(f"Migrated legacy session keys for user {user_id}")
+    return decode_session(session)
+
+
+async def get_session(user_id):
+    """
+    Вся сессия пользователя за один запрос: HGETALL хеша и, для сессий,
+    еще не перенесенных в хеш, чтение старых ключей в том же пайплайне.
+    Повторные чтения обслуживает session_near_cache.
+    """
+    cached = session_near_cache.get(session_key(user_id))
+    if cached is not None:
+        return dict(cached)
+
+    generation = session_near_cache.generation
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(session_key(user_id))
+            pipe.mget(*legacy_session_keys(user_id).values())
+            raw_session, legacy_values = await pipe.execute()
+        session = decode_session(raw_session)
+        if not session and any(legacy_values):
+            session = await migrate_legacy_session(user_id, legacy_values)
+        refresh_local_session(user_id, session)
+        if session:
+            session_near_cache.set(session_key(user_id), session, generation)
+        return dict(session)
+    except RedisError as e:
+        logger.error(f"Redis Error in get_session for user {user_id}: {e}")
+        return get_local_session(user_id)
+
+
+# Переходы сессии выполняются на стороне Redis одним скриптом и
+# возвращают новое состояние сессии (результат HGETALL).
+# KEYS: хеш сессии, затем ключи, удаляемые перед записью.
+# ARGV: TTL сессии, затем пары поле/значение.
+START_SESSION_SCRIPT = """
+redis.call('DEL', unpack(KEYS))
+if #ARGV > 1 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return redis.call('HGETALL', KEYS[1])
+"""
+
+# KEYS: хеш сессии. ARGV: TTL сессии, затем пары поле/значение
+ADVANCE_SESSION_SCRIPT = """
+if #ARGV > 1 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return redis.call('HGETALL', KEYS[1])
+"""
+
+# KEYS: хеш сессии и все связанные с ней ключи
+FINISH_SESSION_SCRIPT = """
+redis.call('DEL', unpack(KEYS))
+return redis.call('HGETALL', KEYS[1])
+"""
+
+start_session_script = redis.register_script(START_SESSION_SCRIPT)
+advance_session_script = redis.register_script(ADVANCE_SESSION_SCRIPT)
+finish_session_script = redis.register_script(FINISH_SESSION_SCRIPT)
+
+
+def session_args(fields):
+    args = [SESSION_TTL]
+    for field, value in fields.items():
+        if value is not None:
+            args.extend((field, value))
+    return args
+
+
+def snapshot_from_reply(reply):
+    """
+    HGETALL внутри Lua возвращает плоский список [поле, значение, ...].
+    """
+    return decode_session(dict(zip(reply[::2], reply[1::2])))
+
+
+async def start_session(user_id, **fields):
+    """
+    Начинает новую сессию: прежняя сессия и ответы опроса удаляются,
+    поля записываются, результат возвращается одним вызовом.
+    """
     try:
-        await redis_operation_with_sync(
-            redis.set, f"user_state:{user_id}", state, user_id=user_id
+        reply = await start_session_script(
+            keys=[
+                session_key(user_id),
+                *legacy_session_keys(user_id).values(),
+                f"survey_answers:{user_id}",
+            ],
+            args=session_args(fields),
         )
-        local_thread_cache[user_id]["state"] = state
+        session_near_cache.invalidate(session_key(user_id))
+        session = snapshot_from_reply(reply)
+        refresh_local_session(user_id, session)
+        return session
     except RedisError as e:
-        logger.error(f"Redis Error in set_user_state for user {user_id}: {e}")
-        local_thread_cache[user_id]["state"] = state
+        logger.error(f"Redis Error in start_session for user {user_id}: {e}")
+        store_local_entry(user_id, dict(fields))
+        return get_local_session(user_id)
 
 
-# Функции для работы с thread_id
-async def get_thread_id(user_id):
+async def advance_session(user_id, **fields):
+    """
+    Записывает поля сессии и возвращает ее новое состояние.
+    """
     try:
-        result = await redis_operation_with_sync(
-            redis.get, f"thread_id:{user_id}", user_id=user_id
+        reply = await advance_session_script(
+            keys=[session_key(user_id)], args=session_args(fields)
         )
-        if result:
-            return result
-        # Если в Redis нет данных, берем их из локального кэша
-        return local_thread_cache.get(user_id, {}).get("thread_id")
+        session_near_cache.invalidate(session_key(user_id))
+        session = snapshot_from_reply(reply)
+        refresh_local_session(user_id, session)
+        return session
     except RedisError as e:
-        logger.error(f"Redis Error in get_thread_id for user {user_id}: {e}")
-        return local_thread_cache.get(user_id, {}).get("thread_id")
+        logger.error(f"Redis Error in advance_session for user {user_id}: {e}")
+        store_local_entry(user_id, {**peek_local_entry(user_id), **fields})
+        return get_local_session(user_id)
 
 
-async def save_thread_id(user_id, thread_id):
+async def finish_session(user_id):
+    """
+    Полная очистка состояния пользователя: сессия, ответы опроса и
+    ключи, оставшиеся от прежнего формата хранения, удаляются атомарно.
+    """
     try:
-        await redis_operation_with_sync(
-            redis.set, f"thread_id:{user_id}", thread_id, user_id=user_id
+        reply = await finish_session_script(
+            keys=[
+                session_key(user_id),
+                *legacy_session_keys(user_id).values(),
+                f"survey_answers:{user_id}",
+                f"processed:{user_id}",
+            ]
         )
-        local_thread_cache[user_id]["thread_id"] = thread_id
+        session = snapshot_from_reply(reply)
     except RedisError as e:
-        logger.error(f"Redis Error in save_thread_id for user {user_id}: {e}")
-        local_thread_cache[user_id]["thread_id"] = thread_id
+        logger.error(f"Redis Error in finish_session for user {user_id}: {e}")
+        session = {}
+    session_near_cache.invalidate(session_key(user_id))
+    clear_local_cache(user_id)
+    return session
 
 
-# Функции для работы с assistant_id
-async def get_assistant_id(user_id):
+async def delete_session_fields(user_id, *fields):
     try:
-        result = await redis_operation_with_sync(
-            redis.get, f"assistant_id:{user_id}", user_id=user_id
-        )
-        if result:
-            return result
-        # Если в Redis нет данных, берем их из локального кэша
-        return local_thread_cache.get(user_id, {}).get("assistant_id")
+        await redis.hdel(session_key(user_id), *fields)
+        session_near_cache.invalidate(session_key(user_id))
     except RedisError as e:
         logger.error(
-            f"Redis Error in get_assistant_id for user {user_id}: {e}"
+            f"Redis Error in delete_session_fields for user {user_id}: {e}"
         )
-        return local_thread_cache.get(user_id, {}).get("assistant_id")
+    cached = peek_local_entry(user_id)
+    for field in fields:
+        cached.pop(field, None)
+    store_local_entry(user_id, cached)
+
+
+# Функция для работы с состоянием пользователя
+async def get_user_state(user_id):
+    return (await get_session(user_id)).get("state")
+
+
+async def set_user_state(user_id, state):
+    await advance_session(user_id, state=state)
+
+
+# Функции для работы с thread_id
+async def get_thread_id(user_id):
+    return (await get_session(user_id)).get("thread_id")
+
+
+async def save_thread_id(user_id, thread_id):
+    await advance_session(user_id, thread_id=thread_id)
+
+
+# Функции для работы с assistant_id
+async def get_assistant_id(user_id):
+    return (await get_session(user_id)).get("assistant_id")
 
 
 async def save_assistant_id(user_id, assistant_id):
-    try:
-        await redis_operation_with_sync(
-            redis.set, f"assistant_id:{user_id}", assistant_id, user_id=user_id
-        )
-        local_thread_cache[user_id]["assistant_id"] = assistant_id
-    except RedisError as e:
-        logger.error(
-            f"Redis Error in save_assistant_id for user {user_id}: {e}"
-        )
-        local_thread_cache[user_id]["assistant_id"] = assistant_id
+    await advance_session(user_id, assistant_id=assistant_id)
 
 
-async def mark_message_as_processed(user_id, message_id):
-    # Приводим message_id к строковому типу, проверяя, что он не None
-    if message_id is None:
-        logger.error(f"message_id is None for user {user_id}")
-        return
+# Функции удаления данных
+async def delete_user_state(user_id):
+    await delete_session_fields(user_id, "state")
 
-    message_id_str = (
-        message_id.decode("utf-8")
-        if isinstance(message_id, bytes)
-        else message_id
-    )
-    logger.info(f"message_id_str {message_id_str} ")
-    try:
-        # Проверка, что message_id_str не является None
-        if message_id_str is None:
-            logger.error(f"message_id_str is None for user {user_id}")
-            return
-
-        # Добавляем сообщение в Redis
-        await redis_operation_with_sync(
-            redis.sadd, f"processed:{user_id}", message_id_str, user_id=user_id
-        )
-        logger.info(
-            f"Marked message {message_id_str} as processed for user {user_id}"
-        )
 
-        # Добавляем сообщение в локальный кэш
-        if "processed_messages" not in local_thread_cache[user_id]:
-            local_thread_cache[user_id]["processed_messages"] = set()
-        local_thread_cache[user_id]["processed_messages"].add(message_id_str)
-        log_local_cache()
-    except RedisError as e:
-        logger.error(
-            f"Redis Error in mark_message_as_processed for user {user_id}: {e}"
-        )
-        # Добавляем сообщение в локальный кэш, если произошла ошибка с Redis
-        if "processed_messages" not in local_thread_cache[user_id]:
-            local_thread_cache[user_id]["processed_messages"] = set()
-        local_thread_cache[user_id]["processed_messages"].add(message_id_str)
-        log_local_cache()
+async def delete_thread_id(user_id):
+    await delete_session_fields(user_id, "thread_id")
+
+
+async def delete_assistant_id(user_id):
+    await delete_session_fields(user_id, "assistant_id")
+
 
+# Функции для работы с шагом ежедневного опроса и ответами на него
+async def get_survey_step(user_id):
+    return (await get_session(user_id)).get("survey_step")
 
-# Проверка, обработано ли сообщение
-async def is_message_processed(user_id, message_id):
-    if message_id is None:
-        logger.error(f"message_id is None for user {user_id}")
-        return False
 
-    message_id_str = (
-        message_id.decode("utf-8")
-        if isinstance(message_id, bytes)
-        else message_id
-    )
+async def set_survey_step(user_id, marker):
+    await advance_session(user_id, survey_step=marker)
 
+
+async def save_survey_answer(user_id, field, value):
+    # Ответы живут столько же, сколько сессия, и удаляются вместе с ней
     try:
-        # Проверка в Redis
-        is_processed = await redis.sismember(
-            f"processed:{user_id}", message_id_str
-        )
-        if is_processed:
-            return True
-        else:
-            # Проверка в локальном кэше
-            processed_messages = local_thread_cache.get(user_id, {}).get(
-                "processed_messages", set()
-            )
-            return message_id_str in processed_messages
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.hset(f"survey_answers:{user_id}", field, value)
+            pipe.expire(f"survey_answers:{user_id}", SESSION_TTL)
+            await pipe.execute()
     except RedisError as e:
         logger.error(
-            f"Redis Error in is_message_processed for user {user_id}: {e}"
-        )
-        # Проверка в локальном кэше при ошибке Redis
-        processed_messages = local_thread_cache.get(user_id, {}).get(
-            "processed_messages", set()
+            f"Redis Error in save_survey_answer for user {user_id}: {e}"
         )
-        return message_id_str in processed_messages
+    cached = peek_local_entry(user_id)
+    cached["survey_answers"] = {
+        **cached.get("survey_answers", {}),
+        field: value,
+    }
+    store_local_entry(user_id, cached)
 
 
-# Функции удаления данных
-async def delete_processed_messages(user_id, message_ids):
+async def get_survey_answers(user_id):
     try:
-        for message_id in message_ids:
-            await redis_operation_with_sync(
-                redis.delete, user_id, f"processed:{message_id}"
+        answers = await redis.hgetall(f"survey_answers:{user_id}")
+        return {
+            (k.decode("utf-8") if isinstance(k, bytes) else k): (
+                v.decode("utf-8") if isinstance(v, bytes) else v
             )
-        await redis_operation_with_sync(
-            redis.delete, user_id, f"processed:{user_id}"
-        )
-        clear_local_cache(user_id)
-        logger.info(f"Deleted processed messages for user {user_id}")
-        log_local_cache()
+            for k, v in answers.items()
+        }
     except RedisError as e:
         logger.error(
-            f"Redis Error in delete_processed_messages for user {user_id}: {e}"
+            f"Redis Error in get_survey_answers for user {user_id}: {e}"
         )
-
-
-async def delete_user_state(user_id):
-    redis_result = await redis_operation_with_sync(
-        redis.delete, f"user_state:{user_id}", user_id=user_id
-    )
-    if redis_result is None:
-        local_thread_cache[user_id].pop("state", None)
-        logger.info(f"Deleted user_state from local cache for user {user_id}")
-
-
-async def delete_thread_id(user_id):
-    redis_result = await redis_operation_with_sync(
-        redis.delete, f"thread_id:{user_id}", user_id=user_id
-    )
-    if redis_result is None:
-        local_thread_cache[user_id].pop("thread_id", None)
-
-
-async def delete_assistant_id(user_id):
-    redis_result = await redis_operation_with_sync(
-        redis.delete, f"assistant_id:{user_id}", user_id=user_id
-    )
-    if redis_result is None:
-        local_thread_cache[user_id].pop("assistant_id", None)
-
-
-# Полная очистка состояния пользователя
-async def clear_user_state(user_id, processed_message_ids):
-    await delete_user_state(user_id)
-    await delete_thread_id(user_id)
-    await delete_assistant_id(user_id)
-    await delete_processed_messages(user_id, processed_message_ids)
+        return dict(get_local_entry(user_id).get("survey_answers", {}))
@@ -0,0 +1,29 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into a single task.
+
+    The task is shielded from the cancellation of any one caller, so a
+    caller that goes away does not abort the work for the others.
+    """
+
+    def __init__(self):
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def run(self, key, factory):
+        """
+        Возвращает (результат, joined): joined равен True, если вызов
+        присоединился к уже выполняющейся задаче.
+        """
+        task = self._pending.get(key)
+        joined = task is not None
+        if not joined:
+            task = asyncio.ensure_future(factory())
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(task), joined
@@ -0,0 +1,111 @@
+import sys
+import time
+from collections import OrderedDict
+
+from utils import metrics
+
+
+class TTLCache:
+    """
+    Bounded in-process LRU cache whose entries expire after a TTL.
+
+    Hits, misses and evictions are reported to utils.metrics under the
+    cache name. With maxbytes set, entries are also evicted once their
+    total size, as estimated by sizeof, exceeds the limit.
+    """
+
+    def __init__(
+        self, name, maxsize=1024, ttl=300, maxbytes=None, sizeof=None
+    ):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or sys.getsizeof
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self._get_entry(key) is not None
+
+    def _get_entry(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, _ = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._remove(key)
+            self._expirations += 1
+            metrics.increment("cache_expired", cache=self.name)
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        entry = self._get_entry(key)
+        if entry is None:
+            metrics.increment("cache_misses", cache=self.name)
+            return default
+        self._data.move_to_end(key)
+        metrics.increment("cache_hits", cache=self.name)
+        return entry[1]
+
+    def peek(self, key, default=None):
+        """
+        Значение без учета в метриках попаданий и без изменения порядка
+        вытеснения: для служебных чтений, а не обращений клиентов кеша.
+        """
+        entry = self._get_entry(key)
+        return default if entry is None else entry[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._remove(key)
+        self._data[key] = (expires_at, value)
+        self._sizes[key] = self.sizeof(value)
+        self._bytes += self._sizes[key]
+        while len(self._data) > self.maxsize or (
+            self.maxbytes is not None
+            and self._bytes > self.maxbytes
+            and len(self._data) > 1
+        ):
+            self._remove(next(iter(self._data)))
+            self._evictions += 1
+            metrics.increment("cache_evictions", cache=self.name)
+        if self.maxbytes is not None:
+            metrics.set_gauge("cache_bytes", self._bytes, cache=self.name)
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        self._bytes -= self._sizes.pop(key, 0)
+        return entry
+
+    def pop(self, key, default=None):
+        entry = self._remove(key)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
+        self._sizes.clear()
+        self._bytes = 0
+
+    def stats(self):
+        """
+        Сводка по кешу для диагностики, без содержимого записей.
+        """
+        return {
+            "name": self.name,
+            "entries": len(self._data),
+            "maxsize": self.maxsize,
+            "bytes": self._bytes,
+            "maxbytes": self.maxbytes,
+            "ttl": self.ttl,
+            "evictions": self._evictions,
+            "expirations": self._expirations,
+        }